@@ -1,80 +1,105 @@
-from flask import Flask, render_template, request, jsonify
-import traceback
-import osmnx as ox
-import networkx as nx
-from graph import prepare_graph
-from routing import heuristic, greedy
-from postprocess import get_route_coordinates, get_stats_of_route, get_elevation_of_route
+from flask import Flask, render_template, request, jsonify, Response, url_for
+import os
+import json
+import metrics
+import parallel
+from pipeline import generate_route as run_pipeline, generate_routes, RouteError
+from jobs import JobManager
+from result_cache import route_cache
+from warmer import CacheWarmer, WARMER_ENABLED
 
 app = Flask(__name__)
 
+# Route jobs submitted through the job API
+job_manager = JobManager()
+
+# Prepares the graphs of popular and configured start points in the background, once started by the server process
+cache_warmer = CacheWarmer()
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
-def read_preferences(elevation, surface, nature, lighting, poi):
-    pref = [0,0,0,0,0,0,0,0]
-    if elevation == "hilly":
-        pref[0] = 1
-    if elevation == "flat":
-        pref[1] = 1
-    if surface == "road":
-        pref[2] = 1
-    if surface == "trail":
-        pref[3] = 1
-    if nature == "yes":
-        pref[4] = 1
-    if lighting == "yes":
-        pref[5] = 1
-    if poi == "tourism":
-        pref[6] = 1
-    if poi == "viewpoint":
-        pref[7] = 1
-
-    return pref
-
 @app.route('/route', methods=['POST'])
 def generate_route():
-    data = request.json
-    lat, long = data.get("coords")
-    distance = data.get("distance")
-    elevation = data.get("elevation")
-    surface = data.get("surface")
-    nature = data.get("nature")
-    lighting = data.get("lighting")
-    poi = data.get("poi")
-    print(f"Received start coords: {lat, long}, distance: {distance}, elevation: {elevation}")
-
-    pref = read_preferences(elevation, surface, nature, lighting, poi)
-    allpref = [1,1,1,1,1,1,1,1]
-
-    try:
-        G = prepare_graph(lat, long, distance, pref, allpref)
-        start_vertex = ox.nearest_nodes(G, long, lat)
-    except Exception as e:
-        traceback.print_exc()
-        return jsonify({"error": "No paths near start point, try changing startpoint"}), 500
-    
     try:
-        route = heuristic(G, start_vertex, distance, [])
+        with metrics.trace() as breakdown:
+            response = run_pipeline(request.json)
+    except RouteError as e:
+        return jsonify({"error": e.message}), e.status
+
+    # In debug mode the response includes where the time of the request went
+    if app.debug:
+        response = dict(response, debug=breakdown)
+    return jsonify(response)
+
+# Counters and stage timers of all requests, in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Generates routes for a list of route requests. The results are streamed as one JSON object per line
+# in the order they finish, with the position of the request in the list
+@app.route('/routes/batch', methods=['POST'])
+def generate_route_batch():
+    route_requests = (request.json or {}).get("requests")
+    if not isinstance(route_requests, list):
+        return jsonify({"error": "Expected a list of route requests"}), 400
+
+    def results():
+        for position, result in generate_routes(route_requests):
+            if isinstance(result, RouteError):
+                line = {"index": position, "error": result.message, "status": result.status}
+            else:
+                line = {"index": position, "result": result}
+            yield json.dumps(line) + "\n"
+
+    return Response(results(), mimetype="application/x-ndjson")
+
+# Returns the hit and miss counters of the route cache
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(route_cache.stats())
+
+# Returns the progress of the cache warmer and the spots it keeps warm
+@app.route('/warmer/status', methods=['GET'])
+def warmer_status():
+    return jsonify(cache_warmer.status())
 
-        if len(route) == 1:
-            route = greedy(G, start_vertex, distance)
+# Submits a route request as a job. The job can be polled, or its progress streamed as server-sent events
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    job = job_manager.submit(request.json)
+    return jsonify({"id": job.id,
+                    "status": job.status,
+                    "statusUrl": url_for("get_job", job_id=job.id),
+                    "eventsUrl": url_for("job_events", job_id=job.id)}), 202
 
-        route_coords = get_route_coordinates(G, route)
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
 
-        route_stats = get_stats_of_route(distance, ox.routing.route_to_gdf(G, route, weight="length"))
-        length = route_stats.get("length", 0)
-        elevation = route_stats.get("elevation", 0)
-        elevation_of_route = get_elevation_of_route(G, route)
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return Response(job_manager.events(job), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
-        return jsonify({"route": route_coords,
-                        "length": length,
-                        "elevation": elevation,
-                        "elevationOfRoute": elevation_of_route})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
 
+# Whether this process handles the requests. With the debug reloader the first process only watches the source files
+# and runs the server in a child process
+def is_serving_process(debug):
+    return not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true"
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    debug = True
+    if is_serving_process(debug):
+        # Start the route workers before the server threads
+        parallel.start_pool()
+        if WARMER_ENABLED:
+            cache_warmer.start()
+    app.run(host='0.0.0.0', port=5000, debug=debug, threaded=True)
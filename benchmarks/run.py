@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import gc
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import shapely
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import synthetic
+import tile_cache
+import elevation
+import snapping
+import graph
+import landmarks
+from edge_store import get_edge_store
+from routing import heuristic, greedy
+from postprocess import summarize_route
+
+# Graph sizes, as the number of intersections along each side of the grid (the random graphs get the same number of nodes)
+SIZES = {"small": 20, "medium": 50, "large": 100}
+KINDS = ["grid", "random"]
+
+# Results committed with the repository, which runs are compared with unless another baseline is given
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Prefers flat trails through nature with lighting, so every feature layer is used
+PREFERENCES = [0, 1, 0, 1, 1, 1, 0, 0]
+ALL_FEATURES = [1, 1, 1, 1, 1, 1, 1, 1]
+
+# Stages measured for every graph, in pipeline order
+STAGES = ["snap", "retrieve_graph", "retrieve_relevant_feature_data", "edge_store", "assign_weights_approx_alg",
+          "assign_weights_heuristic", "heuristic", "greedy", "postprocess"]
+
+# Sets up the tile cache, DEM tiles and feature data of a synthetic graph in a directory, so the pipeline stages
+# run without network access
+def setup_offline_area(G, directory):
+    tile_cache.CACHE_DIR = os.path.join(directory, "tiles")
+    elevation.DEM_DIR = os.path.join(directory, "dem")
+    elevation.ELEVATION_PROVIDER = "raster"
+    elevation.open_tiles.clear()
+    snapping.loaded_indexes.clear()
+
+    synthetic.write_tiles(G)
+    # Tiles around the synthetic area have no paths, instead of being downloaded
+    tile_cache.download_bbox = lambda bbox: synthetic.empty_graph()
+    # The heuristic stage drops its routing graph before each run, so every run would start a landmark index build
+    # in the background that keeps running during the stages measured after it
+    landmarks.LANDMARKS_ENABLED = False
+    synthetic.write_dem(G, elevation.DEM_DIR)
+
+    area_features = synthetic.features(G)
+    graph.retrieve_features = lambda start_point, route_length, tags: query_features(area_features, tags)
+
+# Returns the features matching the tags of a feature query, where the tag values may be lists as in the Overpass queries
+def query_features(features, tags):
+    mask = np.zeros(len(features), dtype=bool)
+    for key, values in tags.items():
+        if key in features.columns:
+            mask |= features[key].isin(values if isinstance(values, list) else [values]).to_numpy()
+    return features[mask]
+
+def remove_elevation(G):
+    for _, data in G.nodes(data=True):
+        data.pop("elevation", None)
+    return G
+
+# Returns a function per stage, each doing one cold run of the stage. State shared between the stages
+# (the retrieved graph, the route) is prepared once, so each run only measures its own stage
+def stage_functions(G, seed=0):
+    lat, long = synthetic.center_of(G)
+    west, south, east, north = synthetic.bbox_of(G)
+    route_length = min(synthetic.edge_length(shapely.LineString([(west, lat), (east, lat)])),
+                       synthetic.edge_length(shapely.LineString([(long, south), (long, north)])))
+
+    rng = np.random.default_rng(seed)
+    snap_lats = rng.uniform(south, north, 1000)
+    snap_longs = rng.uniform(west, east, 1000)
+    start_vertex = snapping.snap_point(lat, long)
+
+    retrieved = graph.retrieve_graph((lat, long), route_length, start_vertex)
+    enriched = graph.retrieve_relevant_feature_data(retrieved.copy(), PREFERENCES, (lat, long), route_length, ALL_FEATURES)
+    store = get_edge_store(enriched)
+    prepared = graph.assign_weights_heuristic(graph.assign_weights_approx_alg(enriched, PREFERENCES), PREFERENCES)
+
+    def reset_weights():
+        store.cache.clear()
+
+    def reset_routing():
+        prepared.graph.pop("routing_graph", None)
+
+    route = heuristic(prepared, start_vertex, route_length, [])
+
+    return route_length, {
+        "snap": (lambda: snapping.loaded_indexes.clear(), lambda: snapping.snap_points(snap_lats, snap_longs)),
+        "retrieve_graph": (None, lambda: graph.retrieve_graph((lat, long), route_length, start_vertex)),
+        "retrieve_relevant_feature_data": (lambda: remove_elevation(retrieved),
+                                           lambda: graph.retrieve_relevant_feature_data(retrieved.copy(), PREFERENCES, (lat, long), route_length, ALL_FEATURES)),
+        "edge_store": (None, lambda: get_edge_store(enriched.copy(), rebuild=True)),
+        "assign_weights_approx_alg": (reset_weights, lambda: graph.assign_weights_approx_alg(prepared, PREFERENCES)),
+        "assign_weights_heuristic": (reset_weights, lambda: graph.assign_weights_heuristic(prepared, PREFERENCES)),
+        "heuristic": (reset_routing, lambda: heuristic(prepared, start_vertex, route_length, [])),
+        "greedy": (reset_routing, lambda: greedy(prepared, start_vertex, route_length)),
+        "postprocess": (None, lambda: summarize_route(prepared, route, route_length)),
+    }
+
+# Runs a stage a number of times and returns its latency percentiles in milliseconds and its peak traced memory in KiB.
+# The memory is measured in a separate run, as tracing slows down the stage
+def measure(reset, function, repeat):
+    timings = []
+    for _ in range(repeat):
+        if reset is not None:
+            reset()
+        # Garbage left by earlier runs is collected before the run instead of during it, as timeit does
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - start) * 1000)
+        finally:
+            gc.enable()
+
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"min": float(np.min(timings)), "p50": float(np.percentile(timings, 50)), "p90": float(np.percentile(timings, 90)),
+            "p99": float(np.percentile(timings, 99)), "max": float(np.max(timings)), "peak_kib": peak / 1024}
+
+# Returns the fastest of several runs of a fixed Python and numpy workload in milliseconds, a measure of the speed of
+# the machine right before a graph is measured. Latencies are compared with a baseline relative to it, so a baseline
+# recorded on another machine, or while the machine was less loaded, is usable
+def calibrate(repeat=10):
+    rng = np.random.default_rng(0)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        values = rng.random(200000)
+        np.sort(values)
+        sum(i * i for i in range(200000))
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+def build_graph(kind, size):
+    n = SIZES[size]
+    if kind == "grid":
+        return synthetic.grid_graph(n)
+    return synthetic.random_geometric_graph(n * n)
+
+def run(kinds, sizes, stages, repeat):
+    results = dict()
+    for kind in kinds:
+        for size in sizes:
+            name = f"{kind}-{size}"
+            directory = tempfile.mkdtemp(prefix="running-routes-benchmark-")
+            try:
+                G = build_graph(kind, size)
+                setup_offline_area(G, directory)
+                route_length, functions = stage_functions(G)
+                results[name] = {"nodes": G.number_of_nodes(), "edges": G.number_of_edges(), "route_length": route_length,
+                                 "calibration_ms": calibrate(), "stages": dict()}
+                for stage in stages:
+                    reset, function = functions[stage]
+                    results[name]["stages"][stage] = measure(reset, function, repeat)
+                    print_stage(name, stage, results[name]["stages"][stage])
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+# Combines the results of several runs of the benchmark into the median of each measure
+def median_of_runs(runs):
+    results = dict()
+    for name, result in runs[0].items():
+        results[name] = dict(result, calibration_ms=float(np.median([run[name]["calibration_ms"] for run in runs])), stages=dict())
+        for stage, measured in result["stages"].items():
+            results[name]["stages"][stage] = {metric: float(np.median([run[name]["stages"][stage][metric] for run in runs])) for metric in measured}
+    return results
+
+def print_stage(name, stage, result):
+    print(f"{name:<14} {stage:<32} p50 {result['p50']:>10.2f} ms  p90 {result['p90']:>10.2f} ms  "
+          f"max {result['max']:>10.2f} ms  peak {result['peak_kib']:>10.0f} KiB", flush=True)
+
+# Compares the results with a baseline. A stage regressed when its fastest run or peak memory grew by more than the
+# tolerance, ignoring changes below a millisecond or 64 KiB. The fastest run is compared as it varies the least with
+# the load of the machine, and it is scaled by the calibration of the graph in both runs. Returns a list of regression
+# descriptions
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        expected_result = baseline.get(name)
+        if expected_result is None:
+            continue
+        speed = result["calibration_ms"] / expected_result["calibration_ms"] if "calibration_ms" in expected_result else 1
+        for stage, measured in result["stages"].items():
+            expected = expected_result["stages"].get(stage)
+            if expected is None:
+                continue
+            for metric, minimum, scale in (("min", 1, speed), ("peak_kib", 64, 1)):
+                if metric not in expected:
+                    continue
+                limit = expected[metric] * scale
+                if measured[metric] > limit * (1 + tolerance) and measured[metric] - limit > minimum:
+                    regressions.append(f"{name} {stage} {metric}: {limit:.2f} -> {measured[metric]:.2f}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the route generation stages on synthetic road networks, without network access")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="Comma separated graph kinds (grid, random)")
+    parser.add_argument("--sizes", default="small,medium", help="Comma separated graph sizes (small, medium, large)")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated stages to measure")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per stage")
+    parser.add_argument("--runs", type=int, default=3, help="Runs of the whole benchmark, the median of each measure is kept")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Compare the results with this JSON file written by an earlier run, "
+                        "benchmarks/baseline.json by default. An empty value skips the comparison")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed relative increase before a stage counts as a regression")
+    args = parser.parse_args()
+
+    results = median_of_runs([run(args.kinds.split(","), args.sizes.split(","), args.stages.split(","), args.repeat) for _ in range(args.runs)])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        # Only the graphs and stages in both the run and the baseline are compared
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
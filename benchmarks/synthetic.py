@@ -0,0 +1,162 @@
+import os
+import sys
+import math
+import numpy as np
+import networkx as nx
+import geopandas as gpd
+import shapely
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tile_cache
+import elevation
+
+# Highway types with how common they are, and the surfaces and share of lit edges for each of them
+HIGHWAYS = {
+    "residential": (0.30, ["asphalt", None], 0.8),
+    "footway": (0.20, ["paving_stones", "asphalt", "gravel", None], 0.5),
+    "path": (0.15, ["ground", "dirt", "gravel", "grass", None], 0.05),
+    "track": (0.10, ["gravel", "dirt", "grass", None], 0.0),
+    "service": (0.10, ["asphalt", None], 0.4),
+    "tertiary": (0.08, ["asphalt"], 0.9),
+    "primary": (0.04, ["asphalt"], 1.0),
+    "cycleway": (0.03, ["asphalt", "fine_gravel"], 0.6),
+}
+
+EARTH_RADIUS_M = 6371009
+
+def meters_to_degrees(lat, dx, dy):
+    return dx / (EARTH_RADIUS_M * math.cos(math.radians(lat))) * 180 / math.pi, dy / EARTH_RADIUS_M * 180 / math.pi
+
+def edge_length(geometry):
+    coords = shapely.get_coordinates(geometry)
+    lats = np.radians(coords[:, 1])
+    longs = np.radians(coords[:, 0])
+    a = np.sin(np.diff(lats) / 2) ** 2 + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(np.diff(longs) / 2) ** 2
+    return float(np.sum(2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))))
+
+# Adds a street between two nodes with random OSM tags, in both directions unless it is one way.
+# Some streets are curved through a node in the middle, like the unsimplified graph of a downloaded tile
+def add_street(G, u, v, osmid, rng):
+    highway = list(HIGHWAYS)[rng.choice(len(HIGHWAYS), p=[share for share, _, _ in HIGHWAYS.values()])]
+    _, surfaces, lit_share = HIGHWAYS[highway]
+
+    start = (G.nodes[u]["x"], G.nodes[u]["y"])
+    end = (G.nodes[v]["x"], G.nodes[v]["y"])
+    nodes = [u, v]
+    if rng.random() < 0.3:
+        bend = rng.normal(0, 0.15)
+        middle = 3 * 10 ** 9 + osmid
+        G.add_node(middle, x=(start[0] + end[0]) / 2 - (end[1] - start[1]) * bend, y=(start[1] + end[1]) / 2 + (end[0] - start[0]) * bend, street_count=2)
+        nodes = [u, middle, v]
+
+    attributes = {"osmid": osmid, "highway": highway, "oneway": False}
+    surface = surfaces[rng.integers(len(surfaces))]
+    if surface is not None:
+        attributes["surface"] = surface
+    if rng.random() < 0.7:
+        attributes["lit"] = "yes" if rng.random() < lit_share else "no"
+
+    # Edges of an unsimplified graph are straight lines without geometry
+    oneway = highway == "primary" and rng.random() < 0.3
+    for a, b in zip(nodes[:-1], nodes[1:]):
+        length = edge_length(shapely.LineString([(G.nodes[a]["x"], G.nodes[a]["y"]), (G.nodes[b]["x"], G.nodes[b]["y"])]))
+        G.add_edge(a, b, 0, reversed=False, **dict(attributes, oneway=oneway, length=length))
+        if not oneway:
+            G.add_edge(b, a, 0, reversed=True, **dict(attributes, length=length))
+
+def empty_graph():
+    return nx.MultiDiGraph(crs="epsg:4326", simplified=False)
+
+# Grid street network with n x n jittered intersections spacing meters apart and a few missing streets
+def grid_graph(n, lat=59.9, long=10.7, spacing=100, seed=0):
+    rng = np.random.default_rng(seed)
+    G = empty_graph()
+    dlong, dlat = meters_to_degrees(lat, spacing, spacing)
+    for i in range(n):
+        for j in range(n):
+            G.add_node(10 ** 9 + i * n + j, y=lat + (i + rng.normal(0, 0.1)) * dlat, x=long + (j + rng.normal(0, 0.1)) * dlong, street_count=4)
+
+    osmid = 10 ** 8
+    for i in range(n):
+        for j in range(n):
+            for di, dj in ((0, 1), (1, 0)):
+                if i + di < n and j + dj < n and rng.random() > 0.05:
+                    add_street(G, 10 ** 9 + i * n + j, 10 ** 9 + (i + di) * n + j + dj, osmid, rng)
+                    osmid += 1
+
+    return nx.MultiDiGraph(G.subgraph(max(nx.weakly_connected_components(G), key=len)))
+
+# Irregular street network with n random intersections, each connected to its nearest neighbours
+def random_geometric_graph(n, lat=59.9, long=10.7, spacing=100, neighbours=3, seed=0):
+    rng = np.random.default_rng(seed)
+    G = empty_graph()
+    side = math.sqrt(n) * spacing
+    dlong, dlat = meters_to_degrees(lat, side, side)
+    points = rng.random((n, 2))
+    for i, (py, px) in enumerate(points):
+        G.add_node(2 * 10 ** 9 + i, y=lat + py * dlat, x=long + px * dlong, street_count=neighbours)
+
+    _, nearest = cKDTree(points).query(points, k=neighbours + 1)
+    pairs = {(min(i, j), max(i, j)) for i, row in enumerate(nearest) for j in row[1:]}
+    for osmid, (i, j) in enumerate(sorted(pairs), start=2 * 10 ** 8):
+        add_street(G, 2 * 10 ** 9 + i, 2 * 10 ** 9 + j, osmid, rng)
+
+    return nx.MultiDiGraph(G.subgraph(max(nx.weakly_connected_components(G), key=len)))
+
+def bbox_of(G):
+    xs = [x for _, x in G.nodes(data="x")]
+    ys = [y for _, y in G.nodes(data="y")]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def center_of(G):
+    west, south, east, north = bbox_of(G)
+    return (south + north) / 2, (west + east) / 2
+
+# Parks, woods and farmland as polygons, and attractions, statues and viewpoints as points, like the
+# GeoDataFrame returned by ox.features.features_from_point
+def features(G, seed=0):
+    rng = np.random.default_rng(seed)
+    west, south, east, north = bbox_of(G)
+    lat = (south + north) / 2
+    rows = []
+
+    for _ in range(max(1, G.number_of_nodes() // 50)):
+        key, value = [("leisure", "park"), ("natural", "wood"), ("landuse", "farmland")][rng.integers(3)]
+        x, y = rng.uniform(west, east), rng.uniform(south, north)
+        dx, dy = meters_to_degrees(lat, rng.uniform(50, 300), rng.uniform(50, 300))
+        rows.append({key: value, "geometry": shapely.box(x, y, x + dx, y + dy)})
+
+    for _ in range(max(1, G.number_of_nodes() // 100)):
+        key, value = [("tourism", "attraction"), ("memorial", "statue"), ("tourism", "viewpoint")][rng.integers(3)]
+        rows.append({key: value, "geometry": shapely.Point(rng.uniform(west, east), rng.uniform(south, north))})
+
+    return gpd.GeoDataFrame(rows, geometry="geometry", crs="epsg:4326")
+
+# Writes SRTM .hgt tiles with rolling hills for all 1x1 degree cells the graph is in
+def write_dem(G, directory, size=1201):
+    os.makedirs(directory, exist_ok=True)
+    west, south, east, north = bbox_of(G)
+    for lat in range(math.floor(south), math.floor(north) + 1):
+        for long in range(math.floor(west), math.floor(east) + 1):
+            lats = np.linspace(lat + 1, lat, size)[:, None]
+            longs = np.linspace(long, long + 1, size)[None, :]
+            heights = 150 + 60 * np.sin(lats * 2 * math.pi / 0.03) + 40 * np.cos(longs * 2 * math.pi / 0.05) + 15 * np.sin((lats + longs) * 2 * math.pi / 0.011)
+            heights.astype(">i2").tofile(os.path.join(directory, elevation.tile_name(lat, long) + ".hgt"))
+
+# Splits the graph into tiles the way tile_cache.download_tile does, and stores them in the tile cache
+def write_tiles(G):
+    tiles = dict()
+    for node, data in G.nodes(data=True):
+        tiles.setdefault(tile_cache.tile_of(data["y"], data["x"]), set()).add(node)
+
+    for tile in tile_cache.tiles_for_bbox(bbox_of(G)):
+        inside = tiles.get(tile, set())
+        # Keep the streets crossing the tile border, like truncate_by_edge
+        nodes = set(inside)
+        for node in inside:
+            nodes.update(G.successors(node))
+            nodes.update(G.predecessors(node))
+        tile_graph = nx.MultiDiGraph(G.subgraph(nodes))
+        tile_graph.graph.update({"crs": "epsg:4326", "simplified": False})
+        tile_cache.save_tile(tile, tile_graph)
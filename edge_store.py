@@ -0,0 +1,146 @@
+import numpy as np
+import networkx as nx
+import shapely
+
+# Codes of the elevation tags in the elev_tag column, 0 is used for edges without a tag
+ELEVATION_TAGS = {"Flat": 1, "Moderate": 2, "Hilly": 3}
+
+# Highway and surface values of trails, all other edges are roads
+TRAIL_HIGHWAYS = {"path", "track"}
+TRAIL_SURFACES = {"fine_gravel", "gravel", "ground", "dirt", "grass"}
+
+# Enrichment layers read from the OSM tags when an edge store is built
+TAG_LAYERS = ["surface", "lit"]
+
+# Names of the node and edge arrays of an edge store
+NODE_COLUMNS = ["nodes", "x", "y", "elevation"]
+EDGE_COLUMNS = ["u", "v", "keys", "length", "rise", "elev_tag", "road", "trail", "nature", "lit", "tourism", "viewpoint",
+                "geometry_offsets", "geometry_coords"]
+
+# Columnar copy of the node and edge attributes of a graph. Edge i is edges[i] = (u, v, key) in the graph,
+# and u[i], v[i] are the positions of its nodes in the node arrays. The geometry of edge i is the points
+# geometry_coords[geometry_offsets[i]:geometry_offsets[i+1]], which is empty for edges without geometry.
+# Layers are the names of the enrichment layers whose columns are filled in
+class EdgeStore:
+    def __init__(self, columns, layers=()):
+        for name in NODE_COLUMNS + EDGE_COLUMNS:
+            setattr(self, name, columns[name])
+        self.layers = list(layers)
+        self.node_index = {node: i for i, node in enumerate(self.nodes.tolist())}
+        self._edges = None
+
+        # Derived arrays (e.g. attribute value matrices and weights) computed from the columns
+        self.cache = dict()
+
+    @property
+    def number_of_edges(self):
+        return len(self.u)
+
+    # The (u, v, key) of every edge, only built when needed
+    @property
+    def edges(self):
+        if self._edges is None:
+            self._edges = list(zip(self.nodes[self.u].tolist(), self.nodes[self.v].tolist(), self.keys.tolist()))
+        return self._edges
+
+    def columns(self):
+        return {name: getattr(self, name) for name in NODE_COLUMNS + EDGE_COLUMNS}
+
+    # Replaces the columns of an enrichment layer, and drops the values derived from the old columns
+    def set_layer(self, layer, columns):
+        for name, values in columns.items():
+            setattr(self, name, values)
+        if layer not in self.layers:
+            self.layers.append(layer)
+        self.cache.clear()
+
+    # Returns a store sharing the arrays of this one, with its own cache for weights
+    def view(self):
+        store = EdgeStore.__new__(EdgeStore)
+        store.__dict__.update(self.__dict__)
+        store.cache = {name: values for name, values in self.cache.items() if not name.startswith("weight_")}
+        return store
+
+def matches(value, values):
+    # Tags of simplified edges can be lists of the tags of the merged ways
+    if isinstance(value, list):
+        return any(v in values for v in value)
+    return value in values
+
+# Tags edges as either trail or road based on their highway and surface tags
+def is_trail(data):
+    return matches(data.get("highway"), TRAIL_HIGHWAYS) or matches(data.get("surface"), TRAIL_SURFACES)
+
+# Reads the node and edge attributes of a graph into arrays. The surface and lit layers are read from the tags,
+# the columns of the other layers are empty until the layers are added
+def build_edge_store(G):
+    node_index = {node: i for i, node in enumerate(G.nodes)}
+    columns = {
+        "nodes": np.array(list(G.nodes), dtype=np.int64),
+        "x": np.array([data["x"] for _, data in G.nodes(data=True)], dtype=np.float64),
+        "y": np.array([data["y"] for _, data in G.nodes(data=True)], dtype=np.float64),
+        "elevation": np.array([data.get("elevation", np.nan) for _, data in G.nodes(data=True)], dtype=np.float64),
+    }
+
+    values = {name: [] for name in ["u", "v", "keys", "length", "road", "trail", "lit"]}
+    geometries = []
+    for u, v, k, data in G.edges(keys=True, data=True):
+        values["u"].append(node_index[u])
+        values["v"].append(node_index[v])
+        values["keys"].append(k)
+        values["length"].append(data["length"])
+        trail = is_trail(data)
+        values["road"].append(not trail)
+        values["trail"].append(trail)
+        values["lit"].append(data.get("lit") == "yes")
+        geometries.append(data.get("geometry"))
+
+    for name in ["u", "v", "keys"]:
+        columns[name] = np.array(values[name], dtype=np.int64)
+    columns["length"] = np.array(values["length"], dtype=np.float64)
+    for name in ["road", "trail", "lit"]:
+        columns[name] = np.array(values[name], dtype=bool)
+    number_of_edges = len(columns["u"])
+    columns["rise"] = np.zeros(number_of_edges, dtype=np.float64)
+    columns["elev_tag"] = np.zeros(number_of_edges, dtype=np.int8)
+    for name in ["nature", "tourism", "viewpoint"]:
+        columns[name] = np.zeros(number_of_edges, dtype=bool)
+
+    # Flatten the edge geometries into one coordinate array with offsets per edge
+    coords, edge_index = shapely.get_coordinates(np.array(geometries, dtype=object), return_index=True)
+    columns["geometry_offsets"] = np.concatenate([[0], np.cumsum(np.bincount(edge_index, minlength=len(geometries)))]).astype(np.int64)
+    columns["geometry_coords"] = coords
+
+    return EdgeStore(columns, TAG_LAYERS)
+
+# Returns the points along edges, and for each point the position of its edge in edge_ids.
+# Edges without geometry are straight lines between their nodes
+def edge_points(store, edge_ids):
+    geometry_starts = store.geometry_offsets[edge_ids]
+    geometry_sizes = store.geometry_offsets[edge_ids + 1] - geometry_starts
+    has_geometry = geometry_sizes > 0
+    sizes = np.where(has_geometry, geometry_sizes, 2)
+
+    # Edge and position within the edge of every point
+    edge_index = np.repeat(np.arange(len(edge_ids)), sizes)
+    position = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+    xy = np.empty((len(edge_index), 2))
+    from_geometry = has_geometry[edge_index]
+    xy[from_geometry] = store.geometry_coords[geometry_starts[edge_index[from_geometry]] + position[from_geometry]]
+    straight_edges = edge_ids[edge_index[~from_geometry]]
+    straight_nodes = np.where(position[~from_geometry] == 0, store.u[straight_edges], store.v[straight_edges])
+    xy[~from_geometry, 0] = store.x[straight_nodes]
+    xy[~from_geometry, 1] = store.y[straight_nodes]
+    return xy, edge_index
+
+# Returns the edge store of a graph. It is kept in the graph attributes, so it is only built once per graph
+def get_edge_store(G, rebuild=False):
+    if rebuild or "edge_store" not in G.graph:
+        G.graph["edge_store"] = build_edge_store(G)
+    return G.graph["edge_store"]
+
+# Writes an array with one value per edge to the graph as an edge attribute
+def set_edge_values(G, store, values, name):
+    nx.set_edge_attributes(G, dict(zip(store.edges, values.tolist())), name=name)
+    return G
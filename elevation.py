@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import math
+import time
+import requests
+import numpy as np
+import networkx as nx
+import tile_cache
+
+# Directory with DEM tiles covering 1x1 degree each, either SRTM .hgt files (e.g. N59E010.hgt)
+# or .npy files with a .json sidecar created by import_geotiff
+DEM_DIR = os.environ.get("DEM_DIR", os.path.join("data", "dem"))
+
+# "raster" samples the local DEM tiles and only asks Open Topo Data for nodes outside them, "opentopodata" always uses the API
+ELEVATION_PROVIDER = os.environ.get("ELEVATION_PROVIDER", "raster")
+OPEN_TOPO_DATA_URL = "https://api.opentopodata.org/v1/aster30m?locations={locations}"
+
+# Elevation API used for nodes outside the DEM tiles, with {locations} replaced by lat,long pairs separated by |.
+# Locations sent per call, seconds between calls (Open Topo Data allows one call per second) and seconds before a call times out
+ELEVATION_API_URL = os.environ.get("ELEVATION_API_URL", OPEN_TOPO_DATA_URL)
+ELEVATION_API_BATCH_SIZE = 100
+ELEVATION_API_PAUSE = 1
+ELEVATION_API_TIMEOUT = 180
+
+# Value used for missing data in SRTM tiles
+HGT_VOID = -32768
+
+class DemTile:
+    def __init__(self, data, west, north, xres, yres, nodata):
+        self.data = data
+        self.west = west
+        self.north = north
+        self.xres = xres
+        self.yres = yres
+        self.nodata = nodata
+
+# Opened tiles, None for cells without a tile. The arrays are memory-mapped, so only the pages that are sampled are read
+open_tiles = dict()
+
+# Returns the name of the tile with its south west corner in lat, long
+def tile_name(lat, long):
+    return f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}{'E' if long >= 0 else 'W'}{abs(long):03d}"
+
+def open_hgt(path, lat, long):
+    # SRTM tiles are square grids of big-endian 16 bit integers, 1201x1201 (3 arc second) or 3601x3601 (1 arc second)
+    size = int(math.isqrt(os.path.getsize(path) // 2))
+    data = np.memmap(path, dtype=">i2", mode="r", shape=(size, size))
+    return DemTile(data, long, lat + 1, 1 / (size - 1), 1 / (size - 1), HGT_VOID)
+
+def open_npy(path):
+    with open(path[:-len(".npy")] + ".json") as f:
+        meta = json.load(f)
+    data = np.load(path, mmap_mode="r")
+    return DemTile(data, meta["west"], meta["north"], meta["xres"], meta["yres"], meta.get("nodata"))
+
+# Returns the DEM tile of the 1x1 degree cell with its south west corner in lat, long, or None if there is none
+def get_tile(lat, long):
+    key = (lat, long)
+    if key not in open_tiles:
+        name = tile_name(lat, long)
+        hgt_path = os.path.join(DEM_DIR, name + ".hgt")
+        npy_path = os.path.join(DEM_DIR, name + ".npy")
+        if os.path.exists(hgt_path):
+            open_tiles[key] = open_hgt(hgt_path, lat, long)
+        elif os.path.exists(npy_path):
+            open_tiles[key] = open_npy(npy_path)
+        else:
+            open_tiles[key] = None
+    return open_tiles[key]
+
+# Bilinear interpolation of the tile values at all the points at once
+def sample_tile(tile, lats, longs):
+    rows, cols = tile.data.shape
+    r = (tile.north - lats) / tile.yres
+    c = (longs - tile.west) / tile.xres
+    r0 = np.clip(np.floor(r).astype(np.int64), 0, rows - 2)
+    c0 = np.clip(np.floor(c).astype(np.int64), 0, cols - 2)
+    fr = np.clip(r - r0, 0, 1)
+    fc = np.clip(c - c0, 0, 1)
+
+    corners = np.stack([
+        tile.data[r0, c0], tile.data[r0, c0 + 1],
+        tile.data[r0 + 1, c0], tile.data[r0 + 1, c0 + 1],
+    ]).astype(np.float64)
+    if tile.nodata is not None:
+        corners[corners == tile.nodata] = np.nan
+
+    top = corners[0] * (1 - fc) + corners[1] * fc
+    bottom = corners[2] * (1 - fc) + corners[3] * fc
+    return top * (1 - fr) + bottom * fr
+
+# Returns the elevation at all the points, NaN where no DEM tile covers the point
+def sample_elevations(lats, longs):
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    elevations = np.full(len(lats), np.nan)
+
+    # Group the points by the 1x1 degree cell they are in and sample each tile once
+    cells = np.stack([np.floor(lats), np.floor(longs)], axis=1).astype(np.int64)
+    unique_cells, cell_index = np.unique(cells, axis=0, return_inverse=True)
+    cell_index = cell_index.reshape(-1)
+    for i, (lat, long) in enumerate(unique_cells):
+        tile = get_tile(int(lat), int(long))
+        if tile is not None:
+            in_cell = cell_index == i
+            elevations[in_cell] = sample_tile(tile, lats[in_cell], longs[in_cell])
+
+    return elevations
+
+# Returns the elevations of the points from an elevation API in the format of Open Topo Data. The URL template is
+# passed per call, so requests using different providers can run at the same time
+def fetch_elevations(lats, longs, url_template=None):
+    if url_template is None:
+        url_template = ELEVATION_API_URL
+
+    elevations = []
+    with requests.Session() as session:
+        for start in range(0, len(lats), ELEVATION_API_BATCH_SIZE):
+            if start > 0:
+                time.sleep(ELEVATION_API_PAUSE)
+            locations = "|".join(f"{lat:.6f},{long:.6f}" for lat, long in zip(lats[start:start + ELEVATION_API_BATCH_SIZE], longs[start:start + ELEVATION_API_BATCH_SIZE]))
+            response = session.get(url_template.format(locations=locations), timeout=ELEVATION_API_TIMEOUT)
+            response.raise_for_status()
+            elevations.extend(result["elevation"] for result in response.json()["results"])
+
+    return np.array([np.nan if elevation is None else elevation for elevation in elevations], dtype=np.float64)
+
+# Returns the elevations of the points, using the local DEM tiles if possible and NaN for points without elevation.
+# The provider and the URL of the elevation API default to the configured ones
+def lookup_elevations(lats, longs, provider=None, url_template=None):
+    if provider is None:
+        provider = ELEVATION_PROVIDER
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+
+    elevations = np.full(len(lats), np.nan)
+    if provider == "raster" and len(lats):
+        elevations = sample_elevations(lats, longs)
+
+    # Fall back to the API for points outside the DEM tiles. Without network access they get no elevation
+    missing = np.flatnonzero(np.isnan(elevations))
+    if len(missing) and not tile_cache.OFFLINE:
+        elevations[missing] = fetch_elevations(lats[missing].tolist(), longs[missing].tolist(), url_template)
+
+    return elevations
+
+# Adds elevation to the nodes that have one
+def add_node_elevations(G, nodes, provider=None, url_template=None):
+    nodes = list(nodes)
+    elevations = lookup_elevations([G.nodes[node]["y"] for node in nodes], [G.nodes[node]["x"] for node in nodes], provider, url_template)
+    found = ~np.isnan(elevations)
+    nx.set_node_attributes(G, dict(zip((n for n, f in zip(nodes, found) if f), elevations[found].tolist())), name="elevation")
+    return G
+
+# Returns the rise and grade of edges from the elevations of their nodes. Edges without length (e.g. between two nodes
+# at the same position) get grade 0, and edges with a node without elevation get NaN
+def edge_grades(elevations, u, v, lengths):
+    rise = elevations[v] - elevations[u]
+    grade = np.divide(rise, lengths, out=np.where(np.isnan(rise), np.nan, 0.0), where=lengths > 0)
+    return rise, grade
+
+# Splits a GeoTIFF DEM in EPSG:4326 into 1x1 degree .npy tiles in DEM_DIR. Requires rasterio
+def import_geotiff(path, out_dir=None):
+    try:
+        import rasterio
+    except ImportError:
+        raise ImportError("Importing GeoTIFF files requires rasterio, install it with: pip install rasterio")
+
+    if out_dir is None:
+        out_dir = DEM_DIR
+    os.makedirs(out_dir, exist_ok=True)
+
+    with rasterio.open(path) as dataset:
+        if dataset.crs is None or dataset.crs.to_epsg() != 4326:
+            raise ValueError("The DEM must use EPSG:4326 coordinates")
+        data = dataset.read(1)
+        transform = dataset.transform
+        nodata = dataset.nodata
+        west, south, east, north = dataset.bounds
+
+    xres, yres = transform.a, -transform.e
+    names = []
+    for lat in range(math.floor(south), math.ceil(north)):
+        for long in range(math.floor(west), math.ceil(east)):
+            # Pixel window of the cell, including one extra row and column for the interpolation at the edges
+            row_start = max(0, math.floor((north - (lat + 1)) / yres))
+            row_end = min(data.shape[0], math.ceil((north - lat) / yres) + 1)
+            col_start = max(0, math.floor((long - west) / xres))
+            col_end = min(data.shape[1], math.ceil((long + 1 - west) / xres) + 1)
+            if row_end - row_start < 2 or col_end - col_start < 2:
+                continue
+
+            name = tile_name(lat, long)
+            np.save(os.path.join(out_dir, name + ".npy"), np.ascontiguousarray(data[row_start:row_end, col_start:col_end]))
+            meta = {
+                # Values are sampled at pixel centres
+                "west": west + (col_start + 0.5) * xres,
+                "north": north - (row_start + 0.5) * yres,
+                "xres": xres,
+                "yres": yres,
+                "nodata": None if nodata is None else float(nodata),
+            }
+            with open(os.path.join(out_dir, name + ".json"), "w") as f:
+                json.dump(meta, f)
+            names.append(name)
+
+    open_tiles.clear()
+    return names
+
+if __name__ == '__main__':
+    # Usage: python elevation.py dem.tif [dem2.tif ...]
+    for path in sys.argv[1:]:
+        print(f"Imported {path} as tiles: {', '.join(import_geotiff(path))}")
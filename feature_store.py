@@ -0,0 +1,60 @@
+import os
+import pickle
+import threading
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import osmnx as ox
+import tile_cache
+
+# Directory with the nature, tourism and viewpoint features of each tile, written by osm_extract.py
+FEATURE_STORE_DIR = os.environ.get("FEATURE_STORE_DIR", os.path.join("cache", "features"))
+
+def feature_path(tile):
+    return os.path.join(FEATURE_STORE_DIR, f"{tile[0]}_{tile[1]}.pkl")
+
+# Writes the features overlapping a tile. The file is written to a temporary path first, so readers never see a partial file
+def save_tile_features(tile, features):
+    os.makedirs(FEATURE_STORE_DIR, exist_ok=True)
+    path = feature_path(tile)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(features, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+# Loads the features of a tile, or None if the tile has no stored features or they are stale
+def load_tile_features(tile):
+    path = feature_path(tile)
+    try:
+        if tile_cache.is_stale(path):
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+# Returns the features matching one of the tags, where the tag values may be a single value or a list of values
+def match_tags(features, tags):
+    mask = np.zeros(len(features), dtype=bool)
+    for key, values in tags.items():
+        if key in features.columns:
+            mask |= features[key].isin(values if isinstance(values, list) else [values]).to_numpy()
+    return features[mask]
+
+# Returns the stored features matching the tags within route length / 2 from the start point, like
+# ox.features.features_from_point. Returns None if the features of the area are not in the store
+def query_features(start_point, route_length, tags):
+    bbox = ox.utils_geo.bbox_from_point(start_point, route_length/2)
+    frames = []
+    for tile in tile_cache.tiles_for_bbox(bbox):
+        features = load_tile_features(tile)
+        if features is None:
+            return None
+        frames.append(features)
+
+    # Features overlapping several tiles are stored in each of them
+    features = pd.concat(frames) if len(frames) > 1 else frames[0]
+    features = features[~features.index.duplicated()]
+    features = features[features.intersects(shapely.box(*bbox))]
+    return gpd.GeoDataFrame(match_tags(features, tags), geometry="geometry", crs="epsg:4326")
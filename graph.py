@@ -1,307 +1,368 @@
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import osmnx as ox
 import geopandas as gpd
+import shapely
 from osmnx._errors import InsufficientResponseError
 import numpy as np
 import networkx as nx
 from collections import defaultdict
 import random
-import math
+import tile_cache
+import elevation
+import feature_store
+import metrics
+import memory
+from edge_store import get_edge_store, set_edge_values, edge_points, ELEVATION_TAGS
+
+# Threads running the independent I/O of the enrichment (feature queries and writing elevations to the tile cache)
+# next to the request thread
+ENRICHMENT_WORKERS = int(os.environ.get("ENRICHMENT_WORKERS", 4))
+enrichment_pool = ThreadPoolExecutor(max_workers=ENRICHMENT_WORKERS, thread_name_prefix="enrichment")
+
+# Runs a function on the enrichment threads in the context of the caller, so its stages are traced with the request
+def submit(function, *args):
+    return enrichment_pool.submit(contextvars.copy_context().run, function, *args)
 
 #Retrives the graph around the start point in a route length / 2 radius
-def retrieve_graph(start_point, route_length):
+def retrieve_graph(start_point, route_length, start_vertex=None):
     try:
         # Retrieve all types of roads/pathways within the radius of route length / 2 from the start in the form of a graph
-        G = ox.graph.graph_from_point(center_point=start_point, dist=route_length/2, dist_type="network", network_type="all", simplify=True)
-
-        # When using a simplified graph the edges that are straight lines get no geometry attribute
-        # Making sure all edges include geometry attribute. Create GeoDataFrames for nodes and edges, with geometry attribute filled in for all edges
-        nodes, edges = ox.graph_to_gdfs(G, fill_edge_geometry=True)
-        # then re-create a graph from those GeoDataFrames
-        G = ox.graph_from_gdfs(nodes, edges, graph_attrs=G.graph)
-
-        # Make sure all edges actually have geometry data
-        for u, v, data in G.edges(keys=False, data=True):
-            assert "geometry" in data
-
-        return G
+        # The graph is stitched together from cached tiles. Edges that are straight lines have no geometry attribute
+        # Long routes only keep the attributes that are used, to bound the memory of their large graphs.
+        # The memory budget is checked as the tiles are stitched together
+        return tile_cache.load_graph(start_point, route_length/2, start_vertex, compact=memory.is_bounded(route_length),
+                                     check=lambda G: memory.check_budget("graph_retrieval", G.number_of_nodes(), G.number_of_edges()))
     except ValueError:
         # Return empty graph
         return nx.MultiDiGraph()
 
-# Adds corresponding elevation data to all nodes in a graph. Using this, it calculates the edge grade and rise for all edges
-def add_elevation(graph):
-    # Assign elevation to all nodes using data from Open Topo Data, then calculate the edge grades
-    original_elevation_url = ox.settings.elevation_url_template
-    ox.settings.elevation_url_template = (
-        "https://api.opentopodata.org/v1/aster30m?locations={locations}"
-    )
-    graph = ox.elevation.add_node_elevations_google(graph, batch_size=100, pause=1)
-    graph = ox.elevation.add_edge_grades(graph)
-    ox.settings.elevation_url_template = original_elevation_url
-
-    for edge in graph.edges:
-        graph.edges[edge]["rise"] = graph.edges[edge]["grade"] * graph.edges[edge]["length"]
-
-    return graph
-
-def assign_elevation_tags(graph):
-    # Get a list including all the absolute edge grades
-    grades = [
-        data["grade_abs"]
-        for _, _, data in graph.edges(data=True)
-        if "grade_abs" in data
-    ]
-
-    # Calculate the 33rd and 66th percentiles
-    p33 = np.percentile(grades, 33)
-    p66 = np.percentile(grades, 66)
-
-    # Assign elevation tags
-    for edge in graph.edges:
-        edge_grade = graph.edges[edge]["grade_abs"]
-        if edge_grade <= p33:
-            graph.edges[edge]["elev_tag"] = "Flat"
-        elif edge_grade <= p66:
-            graph.edges[edge]["elev_tag"] = "Moderate"
-        else:
-            graph.edges[edge]["elev_tag"] = "Hilly"
-
-    return graph
-
-# Return the X and Y values of a series of features. For lines and polygons the coordinates of the centroid is returned
-def get_feature_coordinates(features):
-    return features.geometry.centroid.x, features.geometry.centroid.y
-
-# Tags the closest edge to each viewpoint POI as a viewpoint edge
-def assign_viewpoint_edges(G, start_point, route_length):
-
-    tags = {"tourism": "viewpoint"}
-
-
-    # Find POI features
-    try:
-        viewpoint_features = ox.features.features_from_point(start_point, tags, route_length/2)
-    except InsufficientResponseError:
-        viewpoint_features = None
-    
-    if viewpoint_features is not None and not viewpoint_features.empty:
-        # Project graph to UTM, to be able to measure distance in meters
-        G_proj = ox.project_graph(G)
-
-        # Project the viewpoint features to the same CRS as the graph
-        viewpoint_features_proj = viewpoint_features.to_crs(G_proj.graph['crs'])
-
-        # Connect the viewpoint to their closest edge
-        viewpoint_features_proj_x, viewpoint_features_proj_y = get_feature_coordinates(viewpoint_features_proj)
-        viewpoint_edges = ox.distance.nearest_edges(G_proj, viewpoint_features_proj_x, viewpoint_features_proj_y)
-
-        for edge in viewpoint_edges:
-            G.edges[edge]["Viewpoint"] = True
-
-    return G
-
-# Tags the closest edge to each tourism POI as a tourism edge
-def assign_tourism_edges(G, start_point, route_length):
-
-    tags = {"toursim": "artwork", "memorial": "statue", "tourism": "attraction"}
-
+# Enrichment layers and the preferences that use them. A layer is only computed for a graph when a preference or the
+# route statistics need it, and it is kept in the edge store so later requests only add the layers that are missing
+LAYER_PREFERENCES = {"elevation": [0, 1], "surface": [2, 3], "nature": [4], "lit": [5], "tourism": [6], "viewpoint": [7]}
+LAYERS = list(LAYER_PREFERENCES)
+
+# Edge store columns filled in by each layer
+LAYER_COLUMNS = {"elevation": ["elevation", "rise", "elev_tag"], "surface": ["road", "trail"], "nature": ["nature"],
+                 "lit": ["lit"], "tourism": ["tourism"], "viewpoint": ["viewpoint"]}
+
+# Layers used by the statistics of every route response (the elevation profile and the total rise)
+STATS_LAYERS = ["elevation"]
+
+# Returns the layers a preference vector needs, in the order of LAYERS. With stats=True the layers of the route
+# statistics are included
+def required_layers(pref, stats=True):
+    return [layer for layer in LAYERS if any(pref[i] == 1 for i in LAYER_PREFERENCES[layer]) or (stats and layer in STATS_LAYERS)]
+
+def timed_store_elevations(nodes, lats, longs, values):
+    with metrics.timer("elevation_store"):
+        tile_cache.store_node_values(nodes, lats, longs, "elevation", values)
+
+# Returns the columns of the elevation layer and a future of writing the new elevations to the tile cache, or None.
+# Elevation is only looked up for the nodes the cached tiles have none for. Edges with a node without elevation get
+# no elevation tag and no rise
+def elevation_layer(store):
+    node_elevation = np.array(store.elevation, dtype=np.float64)
+    missing = np.flatnonzero(np.isnan(node_elevation))
+    stored = None
+    if len(missing):
+        node_elevation[missing] = elevation.lookup_elevations(store.y[missing], store.x[missing])
+
+        # Keep the elevation data in the tile cache, so it is not downloaded again for this area. The tiles are
+        # written while the other layers are computed
+        found = missing[~np.isnan(node_elevation[missing])]
+        if len(found):
+            stored = submit(timed_store_elevations, store.nodes[found].tolist(), store.y[found].tolist(),
+                            store.x[found].tolist(), node_elevation[found].tolist())
+
+    rise, grade = elevation.edge_grades(node_elevation, store.u, store.v, store.length)
+    grade_abs = np.abs(grade)
+    known = ~np.isnan(grade_abs)
+
+    # Tag the edges by the 33rd and 66th percentiles of the absolute grades
+    elev_tag = np.zeros(store.number_of_edges, dtype=np.int8)
+    if known.any():
+        p33, p66 = np.percentile(grade_abs[known], [33, 66])
+        elev_tag[known] = np.where(grade_abs[known] <= p33, ELEVATION_TAGS["Flat"],
+                                   np.where(grade_abs[known] <= p66, ELEVATION_TAGS["Moderate"], ELEVATION_TAGS["Hilly"]))
+
+    return {"elevation": node_elevation, "rise": np.nan_to_num(rise), "elev_tag": elev_tag}, stored
+
+# OSM tags of the features used for the nature, tourism and viewpoint edges
+NATURE_TAGS = {"leisure": "park", "natural": "wood", "landuse": "farmland"}
+TOURISM_TAGS = {"toursim": "artwork", "memorial": "statue", "tourism": "attraction"}
+VIEWPOINT_TAGS = {"tourism": "viewpoint"}
+FEATURE_LAYER_TAGS = {"nature": NATURE_TAGS, "tourism": TOURISM_TAGS, "viewpoint": VIEWPOINT_TAGS}
+
+# Combines several tag dictionaries into one, so all the features can be retrieved in a single query
+def combine_tags(tag_dicts):
+    combined = defaultdict(list)
+    for tags in tag_dicts:
+        for key, value in tags.items():
+            if value not in combined[key]:
+                combined[key].append(value)
+    return dict(combined)
+
+# Retrieves all features matching the tags within route length / 2 from the start point
+def retrieve_features(start_point, route_length, tags):
+    # Areas ingested from a local OSM extract are answered from the feature store
+    features = feature_store.query_features(start_point, route_length, tags)
+    if features is not None or tile_cache.OFFLINE:
+        return features
 
-    # Find POI features
     try:
-        tourism_features = ox.features.features_from_point(start_point, tags, route_length/2)
+        return ox.features.features_from_point(start_point, tags, route_length/2)
     except InsufficientResponseError:
-        tourism_features = None
+        return None
 
-    if tourism_features is not None and not tourism_features.empty:
-        # Project graph to UTM, to be able to measure distance in meters
-        G_proj = ox.project_graph(G)
-        
-        # Project the tourism features to the same CRS as the graph
-        tourism_features_proj = tourism_features.to_crs(G_proj.graph['crs'])
-
-        # Connect the viewpoint to their closest edge
-        tourism_features_proj_x, tourism_features_proj_y = get_feature_coordinates(tourism_features_proj)
-        tourism_edges = ox.distance.nearest_edges(G_proj, tourism_features_proj_x, tourism_features_proj_y)
-
-        for edge in tourism_edges:
-            G.edges[edge]["Tourism"] = True
+# Returns the features matching one of the tags
+def select_features(features, tags):
+    mask = np.zeros(len(features), dtype=bool)
+    for key, value in tags.items():
+        if key in features.columns:
+            mask |= (features[key] == value).to_numpy()
+    return features[mask]
 
+# Return the X and Y values of a series of features. For lines and polygons the coordinates of the centroid is returned
+def get_feature_coordinates(features):
+    centroids = features.geometry.centroid
+    return centroids.x, centroids.y
+
+# Projects the edges of an edge store to UTM, to be able to measure distance in meters, and builds a spatial index
+# over them. Edges without geometry are straight lines between their nodes
+def build_edge_index(store):
+    xy, edge_index = edge_points(store, np.arange(store.number_of_edges))
+    geometries = gpd.GeoSeries(shapely.linestrings(xy, indices=edge_index), crs=ox.settings.default_crs)
+    geometries = geometries.to_crs(geometries.estimate_utm_crs())
+    return shapely.STRtree(geometries.values), geometries.crs
+
+# Marks the closest edge to each POI
+def nearest_edges(store, edge_index, features):
+    tree, crs = edge_index
+    near = np.zeros(store.number_of_edges, dtype=bool)
+    if features.empty:
+        return near
+
+    # Project the features to the same CRS as the edges and connect them to their closest edge
+    features_x, features_y = get_feature_coordinates(features.to_crs(crs))
+    _, edge_indices = tree.query_nearest(shapely.points(features_x, features_y), all_matches=False)
+    near[edge_indices] = True
+    return near
+
+# Side in meters of the squares the nature features are processed in, so only the buffers of one square are in memory at a time
+NATURE_CHUNK_SIZE = 2000
+
+# Marks all edges that are within 15 of park, wood or farmland as nature edges
+def nature_edges(store, edge_index, nature_features):
+    tree, crs = edge_index
+    near_nature = np.zeros(store.number_of_edges, dtype=bool)
+    if nature_features.empty:
+        return near_nature
+
+    # Project only the geometries of the nature features to the same CRS as the edges, and group them by the square their centroid is in
+    buffer_distance = 15
+    geometries = np.asarray(nature_features.geometry.to_crs(crs).values)
+    centroids = shapely.centroid(geometries)
+    squares = np.floor(np.column_stack([shapely.get_x(centroids), shapely.get_y(centroids)]) / NATURE_CHUNK_SIZE)
+    _, chunks = np.unique(squares, axis=0, return_inverse=True)
+    chunks = chunks.ravel()
+
+    # Mark edges as near nature if they intersect one of the features buffered by 15m, using the spatial index for all
+    # the features of a square at once
+    for chunk in range(chunks.max() + 1):
+        buffered_nature = shapely.buffer(geometries[chunks == chunk], buffer_distance)
+        _, edge_indices = tree.query(buffered_nature, predicate="intersects")
+        near_nature[edge_indices] = True
+
+    return near_nature
+
+# Returns the tags to retrieve for the nature, tourism and viewpoint layers among the layers
+def wanted_feature_tags(layers):
+    return combine_tags(FEATURE_LAYER_TAGS[layer] for layer in layers if layer in FEATURE_LAYER_TAGS)
+
+def timed_retrieve_features(start_point, route_length, tags):
+    with metrics.timer("feature_retrieval"):
+        return retrieve_features(start_point, route_length, tags)
+
+# Starts retrieving the features of the layers on the enrichment threads and returns a future of them, or None if
+# none of the layers use features. The features only depend on the start point and route length, so they can be
+# retrieved while the graph is downloaded
+def start_feature_retrieval(start_point, route_length, layers):
+    tags = wanted_feature_tags(layers)
+    if not tags:
+        return None
+    return submit(timed_retrieve_features, start_point, route_length, tags)
+
+# Returns the columns of the nature, tourism and viewpoint layers from a single feature query, using a single
+# projection of the edges
+def feature_layers(store, layers, features):
+    columns = {layer: np.zeros(store.number_of_edges, dtype=bool) for layer in layers}
+    if features is None or features.empty:
+        return columns
+
+    edge_index = build_edge_index(store)
+    if "nature" in layers:
+        columns["nature"] = nature_edges(store, edge_index, select_features(features, NATURE_TAGS))
+    if "tourism" in layers:
+        columns["tourism"] = nearest_edges(store, edge_index, select_features(features, TOURISM_TAGS))
+    if "viewpoint" in layers:
+        columns["viewpoint"] = nearest_edges(store, edge_index, select_features(features, VIEWPOINT_TAGS))
+
+    return columns
+
+# Adds the layers an edge store is missing and returns the layers added. The surface and lit layers are read from the
+# tags when the store is built. Features is an optional future of the features of the layers, from start_feature_retrieval
+def add_layers(store, layers, start_point, route_length, features=None):
+    missing = [layer for layer in layers if layer not in store.layers]
+    if not missing or store.number_of_edges == 0:
+        return []
+
+    feature_layer_names = [layer for layer in missing if layer in FEATURE_LAYER_TAGS]
+    if features is None:
+        features = start_feature_retrieval(start_point, route_length, feature_layer_names)
+
+    stored = None
+    if "elevation" in missing:
+        with metrics.timer("elevation"):
+            columns, stored = elevation_layer(store)
+        store.set_layer("elevation", columns)
+
+    if feature_layer_names:
+        with metrics.timer("features"):
+            columns = feature_layers(store, feature_layer_names, features.result() if features is not None else None)
+        for layer in feature_layer_names:
+            store.set_layer(layer, {layer: columns[layer]})
+
+    if stored is not None:
+        stored.result()
+    for layer in missing:
+        metrics.count("enrichment_layers", layer=layer)
+    return missing
+
+# Returns a center and a route length whose feature query covers all the nodes of an edge store, for adding layers
+# to a graph prepared around another start point
+def store_extent(store):
+    west, east = float(store.x.min()), float(store.x.max())
+    south, north = float(store.y.min()), float(store.y.max())
+    lat, long = (south + north) / 2, (west + east) / 2
+    width = ox.distance.great_circle(lat, west, lat, east)
+    height = ox.distance.great_circle(south, long, north, long)
+    return (lat, long), max(width, height)
+
+# Adds the layers of the features in features_wanted (same size as in preference vector) to the edge store of the graph.
+# The features are retrieved on the enrichment threads while the elevation is added, unless a future of them is passed in
+def retrieve_relevant_feature_data(G, pref, start_point, route_length, features_wanted, features=None):
+    add_layers(get_edge_store(G), required_layers(features_wanted, stats=False), start_point, route_length, features)
     return G
 
-# Tags all edges that are within 15 of park, wood or farmland as a nature edge
-def assign_nature_edges(G, start_point, route_length):
+# Attribute values of the flat and hilly preferences, for edges without elevation tag and tagged Flat, Moderate and Hilly
+ELEVATION_VALUES_APPROX_ALG = np.array([[0, 0], [2, 0.5], [1, 1], [0.5, 2]])
+ELEVATION_VALUES_HEURISTIC = np.array([[1, 1], [0.7, 1.3], [1, 1], [1, 0.7]])
 
-    nature_feature_tags = {"leisure": "park", "natural": "wood", "landuse": "farmland"}
+# Returns an E x 8 matrix with the attribute values of all edges for the approximation algorithm
+def calculate_attribute_values_approx_alg(store):
+    if "attribute_values_approx_alg" not in store.cache:
+        attribute_values = np.zeros((store.number_of_edges, 8))
 
-    # Add nature data to edges
-    try:
-        nat_features = ox.features.features_from_point(start_point, nature_feature_tags, route_length/2)
-    except InsufficientResponseError:
-        nat_features = None
+        # Flat and hilly attribute value
+        attribute_values[:, 0:2] = ELEVATION_VALUES_APPROX_ALG[store.elev_tag]
 
-    if nat_features is not None and not nat_features.empty:
+        # Road, trail, nature and lighting attribute values
+        attribute_values[:, 2] = np.where(store.road, 2, 0)
+        attribute_values[:, 3] = np.where(store.road, 0, 2)
+        attribute_values[:, 4] = np.where(store.nature, 2, 0)
+        attribute_values[:, 5] = np.where(store.lit, 2, 0)
 
-        # Project graph to UTM, to be able to measure distance in meters
-        G_proj = ox.project_graph(G)
-    
-        # Project the nature features to the same CRS as the graph
-        nat_features_proj = nat_features.to_crs(G_proj.graph['crs'])
-
-        # Create a buffer of 15m around the nature features
-        buffer_distance = 15
-        buffered_nature = nat_features_proj.buffer(buffer_distance)
-        buffered_union = gpd.GeoSeries(buffered_nature).union_all()
-
-        # Mark edges as near nature if they intersect the buffered union
-        for u, v, k, data in G_proj.edges(keys=True, data=True):
-            edge = (u, v, k)
-            geom = data.get("geometry")
-            if geom is not None and geom.intersects(buffered_union):
-                G.edges[edge]["Nature"] = True
-            else:
-                G.edges[edge]["Nature"] = False
+        # POI attribute values
+        attribute_values[:, 6] = np.where(store.tourism, 2, 0)
+        attribute_values[:, 7] = np.where(store.viewpoint, 2, 0)
 
-    return G
+        store.cache["attribute_values_approx_alg"] = attribute_values
 
-# Tag edges as either trail or road based on surface types of edge
-def assign_surface_types(G):
-    trail_surfaces ={"fine_gravel", "gravel", "ground", "dirt", "grass"}
-    trail_highways = {"path", "track"}
+    return store.cache["attribute_values_approx_alg"]
 
-    for u, v, k, data in G.edges(keys=True, data=True):
-        edge_type = data.get("highway")
-        surface = data.get("surface")
+# Returns the approximation algorithm weights of all edges for a preference vector
+def weights_approx_alg(store, pref):
+    the_sum = calculate_attribute_values_approx_alg(store) @ np.asarray(pref, dtype=np.float64)
+    return store.length * np.maximum(1, the_sum)
 
-        # Handle cases where edge_type and/or surface are lists
-        if isinstance(edge_type, list):
-            type_match = any(t in trail_highways for t in edge_type)
-        else:
-            type_match = edge_type in trail_highways
+def assign_weights_approx_alg(G, pref):
+    store = get_edge_store(G)
+    weights = weights_approx_alg(store, pref)
+    store.cache["weight_approx_alg"] = weights
+    G.graph.pop("routing_graph", None)
+    return set_edge_values(G, store, weights, "weight_approx_alg")
 
-        if isinstance(surface, list):
-            surface_match = any(s in trail_surfaces for s in surface)
-        else:
-            surface_match = surface in trail_surfaces
+# Returns an E x 8 matrix with the attribute values of all edges for the heuristic
+def calculate_attribute_values_heuristic(store):
+    if "attribute_values_heuristic" not in store.cache:
+        attribute_values = np.ones((store.number_of_edges, 8))
 
-        if type_match or surface_match:
-            G.edges[u, v, k]["Trail"] = True
-        else:
-            G.edges[u, v, k]["Road"] = True
+        # Flat and hilly attribute value
+        attribute_values[:, 0:2] = ELEVATION_VALUES_HEURISTIC[store.elev_tag]
 
-    return G
+        # Road, trail, nature and lighting attribute values
+        attribute_values[:, 2] = np.where(store.road, 0.7, 1)
+        attribute_values[:, 3] = np.where(store.road, 1, 0.7)
+        attribute_values[:, 4] = np.where(store.nature, 0.7, 1)
+        attribute_values[:, 5] = np.where(store.lit, 0.7, 1)
 
-# Retrives feature data for the specified features in features_wanted (same size as in preference vector)
-def retrieve_relevant_feature_data(G, pref, start_point, route_length, features_wanted):
-    
-    if features_wanted[0] == 1 or features_wanted[1] == 1:
-        G = add_elevation(G)
-        G = assign_elevation_tags(G)
-
-    if features_wanted[2] == 1 or features_wanted[3] == 1:
-        G = assign_surface_types(G)
-    if features_wanted[4] == 1:
-        G = assign_nature_edges(G, start_point, route_length)
-    # Lighting data already present in G
-    if features_wanted[6] == 1:
-        G = assign_tourism_edges(G, start_point, route_length)
-    if features_wanted[7] == 1:
-        G = assign_viewpoint_edges(G, start_point, route_length)
-    
-    return G
+        store.cache["attribute_values_heuristic"] = attribute_values
 
-def calculate_attribute_values_approx_alg(edge_data):
-    attribute_values = 8 * [0]
-
-    # Flat and hilly attribute value
-    match edge_data.get("elev_tag"):
-        case "Flat":
-            attribute_values[0] = 2
-            attribute_values[1] = 0.5
-        case "Moderate":
-            attribute_values[0] = 1
-            attribute_values[1] = 1
-        case "Hilly":
-            attribute_values[0] = 0.5
-            attribute_values[1] = 2
-    
-    # Road, trail, nature and lighting attribute values
-    if edge_data.get("Road") == True:
-        attribute_values[2] = 2
-    else:
-        attribute_values[3] = 2
+    return store.cache["attribute_values_heuristic"]
 
-    if edge_data.get("Nature") == True:
-        attribute_values[4] = 2
+# Returns the heuristic weights of all edges for a preference vector
+def weights_heuristic(store, pref):
+    factors = calculate_attribute_values_heuristic(store) ** np.asarray(pref, dtype=np.float64)
+    return store.length * np.prod(factors, axis=1)
 
-    if edge_data.get("lit") == "yes":
-        attribute_values[5] = 2
-    
-    # POI attribute values
-    if edge_data.get("Tourism") == True:
-        attribute_values[6] = 2
-    if edge_data.get("Viewpoint") == True:
-        attribute_values[7] = 2
+def assign_weights_heuristic(G, pref):
+    store = get_edge_store(G)
+    weights = weights_heuristic(store, pref)
+    store.cache["weight_heuristic"] = weights
+    G.graph.pop("routing_graph", None)
+    return set_edge_values(G, store, weights, "weight_heuristic")
+
+# Reads a retrieved graph into an edge store and adds the layers to it. Features is an optional future of the
+# features, from start_feature_retrieval
+def enrich_layers(G, lat, long, route_length, layers, features=None):
+    if G.number_of_nodes() != 0:
+        # Read the edge attributes into arrays, which the layers and weights are calculated from
+        memory.check_budget("edge_store", G.number_of_nodes(), G.number_of_edges())
+        with metrics.timer("edge_store"):
+            store = get_edge_store(G)
 
-    return attribute_values
+        add_layers(store, layers, (lat, long), route_length, features)
 
-def assign_weights_approx_alg(G, pref):
-    for u, v, k, data in G.edges(keys=True, data=True):
-        edge = (u, v, k)
-        attribute_values = calculate_attribute_values_approx_alg(data)
-        the_sum = sum(a * b for a, b in zip(pref, attribute_values))
-        G.edges[edge]["weight_approx_alg"] = data["length"] * max(1, the_sum)
-        
     return G
 
-def calculate_attribute_values_heuristic(edge_data):
-    attribute_values = 8 * [1]
-
-    # Flat and hilly attribute value
-    match edge_data.get("elev_tag"):
-        case "Flat":
-            attribute_values[0] = 0.7
-            attribute_values[1] = 1.3
-        case "Moderate":
-            attribute_values[0] = 1
-            attribute_values[1] = 1
-        case "Hilly":
-            attribute_values[1] = 1.3
-            attribute_values[1] = 0.7
-    
-    # Road, trail, nature and lighting attribute values
-    if edge_data.get("Road") == True:
-        attribute_values[2] = 0.7
-    else:
-        attribute_values[3] = 0.7
-
-    if edge_data.get("Nature") == True:
-        attribute_values[4] = 0.7
-
-    if edge_data.get("lit") == "yes":
-        attribute_values[5] = 0.7
+# Adds the layers of the preferences and the statistics, and edge weights based on preferences to a retrieved graph
+def enrich_graph(G, lat, long, route_length, pref, features_wanted, features=None):
+    if G.number_of_nodes() != 0:
+        G = enrich_layers(G, lat, long, route_length, required_layers(features_wanted), features)
 
-    return attribute_values
+        # Assign edge weights based on preferences and feature data
+        with metrics.timer("weights"):
+            G = assign_weights_approx_alg(G, pref)
+            G = assign_weights_heuristic(G, pref)
 
-def assign_weights_heuristic(G, pref):
-    for u, v, k, data in G.edges(keys=True, data=True):
-        edge = (u, v, k)
-        attribute_values = calculate_attribute_values_heuristic(data)
-        G.edges[edge]["weight_heuristic"] = data["length"] * math.prod(a ** b for a, b in zip(attribute_values, pref))
-        
     return G
 
 # Prepares the graph for a route starting in a location with a specific route length
-def prepare_graph(lat, long, route_length, pref, features_wanted):
+# The optional progress function is called with the name of each stage when it is finished
+def prepare_graph(lat, long, route_length, pref, features_wanted, progress=None):
     start_point = lat, long
 
-    # Retrieve graph and relevant feature data
-    G = retrieve_graph(start_point, route_length)
-    
-    if G.number_of_nodes() != 0:
-        G = retrieve_relevant_feature_data(G, pref, start_point, route_length, features_wanted)
+    # Retrieve graph and relevant feature data. The features are retrieved while the graph is downloaded
+    features = start_feature_retrieval(start_point, route_length, required_layers(features_wanted))
+    with metrics.timer("graph_retrieval"):
+        G = retrieve_graph(start_point, route_length)
+    if progress is not None:
+        progress("graph")
 
-        # Assign edge weights based on preferences and feature data
-        G = assign_weights_approx_alg(G, pref)
-        G = assign_weights_heuristic(G, pref)
+    G = enrich_graph(G, lat, long, route_length, pref, features_wanted, features)
+    if progress is not None:
+        progress("enrichment")
     
     return G
\ No newline at end of file
@@ -0,0 +1,81 @@
+import os
+import math
+import time
+import threading
+
+# Start points within this many meters of a warm spot are routed on the graph of the spot, which is prepared for
+# routes 2 * WARM_SPOT_RADIUS longer than the longest route asked for there
+WARM_SPOT_RADIUS = float(os.environ.get("WARM_SPOT_RADIUS", 500))
+
+# Number of start vertices tracked, the least requested ones are forgotten first
+HOTSPOT_LIMIT = int(os.environ.get("HOTSPOT_LIMIT", 1000))
+
+# Number of preference profiles remembered per spot, the weights of which are prepared when the spot is warmed
+HOTSPOT_PREFERENCES = 8
+
+EARTH_RADIUS_M = 6371009
+
+def haversine(lat1, long1, lat2, long2):
+    lat1, long1, lat2, long2 = map(math.radians, (lat1, long1, lat2, long2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+# Start vertices of route requests, with how often and how far routes are asked for from them, and the state of
+# their prepared graph. Spots can also come from a configured list, those are always kept warm
+class Hotspots:
+    def __init__(self, limit):
+        self.limit = limit
+        self.spots = dict()
+        self.lock = threading.Lock()
+
+    # Counts a route request from a start vertex. Configured spots are added with a key of their own, as their start
+    # point is only snapped when they are warmed. The center is the start vertex the graph of the spot is prepared around
+    def record(self, key, lat, long, distance, pref, configured=False):
+        with self.lock:
+            spot = self.spots.get(key)
+            if spot is None:
+                if len(self.spots) >= self.limit:
+                    self.forget()
+                spot = {"key": key, "coords": [lat, long], "distance": 0, "requests": 0, "lastRequest": None,
+                        "preferences": [], "configured": False, "status": "cold", "center": None, "packedKey": None,
+                        "preparedDistance": None, "preparedAt": None, "failedAt": None, "error": None}
+                self.spots[key] = spot
+
+            spot["distance"] = max(spot["distance"], distance)
+            spot["configured"] = spot["configured"] or configured
+            if not configured:
+                spot["requests"] += 1
+                spot["lastRequest"] = time.time()
+            if list(pref) in spot["preferences"]:
+                spot["preferences"].remove(list(pref))
+            spot["preferences"].insert(0, list(pref))
+            del spot["preferences"][HOTSPOT_PREFERENCES:]
+
+    # Forgets the least requested spot that is not configured. Must be called with the lock held
+    def forget(self):
+        candidates = [spot for spot in self.spots.values() if not spot["configured"]]
+        if candidates:
+            spot = min(candidates, key=lambda spot: (spot["requests"], spot["lastRequest"] or 0))
+            del self.spots[spot["key"]]
+
+    def update(self, key, **changes):
+        with self.lock:
+            if key in self.spots:
+                self.spots[key].update(changes)
+
+    # Returns copies of all spots, safe to read while the spots are updated
+    def snapshot(self):
+        with self.lock:
+            return [dict(spot, preferences=list(spot["preferences"])) for spot in self.spots.values()]
+
+    # Returns the warm spots within WARM_SPOT_RADIUS of a point whose graph was prepared for routes of at least
+    # distance, nearest first
+    def warm_spots(self, lat, long, distance):
+        with self.lock:
+            spots = [dict(spot) for spot in self.spots.values()
+                     if spot["preparedAt"] is not None and spot["preparedDistance"] >= distance]
+        spots = [(haversine(lat, long, *spot["coords"]), spot) for spot in spots]
+        return [spot for gap, spot in sorted(spots, key=lambda item: item[0]) if gap <= WARM_SPOT_RADIUS]
+
+# Spots of the requests handled by this process
+hotspots = Hotspots(HOTSPOT_LIMIT)
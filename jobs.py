@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import generate_route, RouteError, STAGES
+
+# Number of route jobs running at the same time, and seconds finished jobs are kept for polling
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_TTL = float(os.environ.get("JOB_TTL", 600))
+
+# Seconds between keep-alive comments on an idle event stream
+KEEP_ALIVE_INTERVAL = 15
+
+class Job:
+    def __init__(self, key, data):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.data = data
+        self.status = "queued"
+        self.stages = []
+        self.result = None
+        self.error = None
+        self.error_status = None
+        self.finished_at = None
+
+        # Notified every time the job changes, for the event streams waiting on it
+        self.changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def to_dict(self):
+        job = {"id": self.id, "status": self.status, "stages": list(self.stages), "allStages": STAGES}
+        if self.status == "done":
+            job["result"] = self.result
+        if self.status == "failed":
+            job["error"] = self.error
+        return job
+
+    def update(self, **changes):
+        with self.changed:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.changed.notify_all()
+
+# Runs route requests on a bounded thread pool. Requests with the same parameters share one job while it is in flight
+class JobManager:
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or JOB_WORKERS, thread_name_prefix="route-job")
+        self.jobs = dict()
+        self.in_flight = dict()
+        self.lock = threading.Lock()
+
+    # Submits a route request and returns its job, or the in-flight job of an identical request
+    def submit(self, data):
+        key = json.dumps(data, sort_keys=True)
+        with self.lock:
+            self.remove_expired()
+            job = self.in_flight.get(key)
+            if job is not None:
+                return job
+
+            job = Job(key, data)
+            self.jobs[job.id] = job
+            self.in_flight[key] = job
+
+        self.executor.submit(self.run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def run(self, job):
+        job.update(status="running")
+        try:
+            result = generate_route(job.data, progress=lambda stage: job.update(stages=job.stages + [stage]))
+            changes = {"status": "done", "result": result}
+        except RouteError as e:
+            changes = {"status": "failed", "error": e.message, "error_status": e.status}
+        except Exception as e:
+            changes = {"status": "failed", "error": str(e), "error_status": 500}
+
+        with self.lock:
+            self.in_flight.pop(job.key, None)
+        job.update(finished_at=time.time(), **changes)
+
+    def remove_expired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items() if job.finished and now - job.finished_at > JOB_TTL]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    # Yields server-sent events for each finished stage of the job, then its result or error
+    def events(self, job):
+        sent_stages = 0
+        while True:
+            with job.changed:
+                if len(job.stages) == sent_stages and not job.finished:
+                    job.changed.wait(timeout=KEEP_ALIVE_INTERVAL)
+                stages = list(job.stages)
+                finished = job.finished
+
+            if len(stages) == sent_stages and not finished:
+                yield ": keep-alive\n\n"
+                continue
+
+            for stage in stages[sent_stages:]:
+                yield format_event("progress", {"id": job.id, "stage": stage, "stages": stages})
+            sent_stages = len(stages)
+
+            if finished:
+                yield format_event("done" if job.status == "done" else "error", job.to_dict())
+                return
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,178 @@
+import os
+import heapq
+import hashlib
+import threading
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from networkx.exception import NetworkXNoPath
+import metrics
+
+# Number of landmarks per index. More landmarks give tighter bounds, at the cost of memory and build time
+LANDMARK_COUNT = int(os.environ.get("LANDMARK_COUNT", 8))
+
+# Set to 0 to never build landmark indexes
+LANDMARKS_ENABLED = os.environ.get("LANDMARKS_ENABLED", "1") != "0"
+
+# Whether missing indexes are built in background threads. Worker processes only use the indexes shared with them
+BACKGROUND_BUILDS = True
+
+# Distances from and to a set of landmark nodes for one weight of a routing graph, with a row of K distances per node.
+# By the triangle inequality, max(d(L, t) - d(L, u), d(u, L) - d(t, L)) over the landmarks L is a lower bound
+# of the distance from u to t
+class LandmarkIndex:
+    def __init__(self, landmarks, from_landmarks, to_landmarks, fingerprint):
+        self.landmarks = landmarks
+        self.from_landmarks = from_landmarks
+        self.to_landmarks = to_landmarks
+        self.fingerprint = fingerprint
+
+    # Returns a function giving the lower bound of the distance from a node index to the target.
+    # Bounds are computed when first asked for, as a search only reaches a small part of the graph
+    def lower_bound(self, target):
+        from_target = self.from_landmarks[target].tolist()
+        to_target = self.to_landmarks[target].tolist()
+        bounds = dict()
+
+        def bound(node):
+            value = bounds.get(node)
+            if value is None:
+                value = 0.0
+                # Differences of two unreachable distances are nan, which never compare greater
+                for from_l_t, from_l_u, to_l_u, to_l_t in zip(from_target, self.from_landmarks[node].tolist(),
+                                                              self.to_landmarks[node].tolist(), to_target):
+                    if from_l_t - from_l_u > value:
+                        value = from_l_t - from_l_u
+                    if to_l_u - to_l_t > value:
+                        value = to_l_u - to_l_t
+                bounds[node] = value
+            return value
+        return bound
+
+# Returns a fingerprint of the edges of a routing graph and the values of one of its weights.
+# An index is only used with the graph and weights it was built for
+def fingerprint(rg, weight):
+    digest = hashlib.sha1()
+    for values in (rg.nodes, rg.u, rg.v, rg.weights[weight]):
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+# Picks landmarks spread over the graph: each next landmark is the node farthest from the ones picked so far
+def select_landmarks(matrix, count):
+    landmarks = [0]
+    closest = np.full(matrix.shape[0], np.inf)
+    for _ in range(count + 1):
+        distances = dijkstra(matrix, directed=False, indices=landmarks[-1])
+        closest = np.minimum(closest, np.where(np.isfinite(distances), distances, -1))
+        landmarks.append(int(np.argmax(closest)))
+    # The first node was only used to find a node on the edge of the graph
+    return sorted(set(landmarks[1:]))[:count]
+
+def build_landmark_index(rg, weight, count=None):
+    if count is None:
+        count = LANDMARK_COUNT
+    matrix, _ = rg.get_adjacency(weight)
+    landmarks = np.array(select_landmarks(matrix, min(count, rg.number_of_nodes)), dtype=np.int64)
+    from_landmarks = np.ascontiguousarray(dijkstra(matrix, directed=True, indices=landmarks).T)
+    to_landmarks = np.ascontiguousarray(dijkstra(matrix.T.tocsr(), directed=True, indices=landmarks).T)
+    return LandmarkIndex(landmarks, from_landmarks, to_landmarks, fingerprint(rg, weight))
+
+def index_path(directory, key):
+    return os.path.join(directory, f"landmarks_{key}.npz")
+
+def save_landmark_index(index, path):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+    np.savez(tmp_path, landmarks=index.landmarks, from_landmarks=index.from_landmarks, to_landmarks=index.to_landmarks,
+             fingerprint=np.array(index.fingerprint))
+    os.replace(tmp_path, path)
+
+# Loads a stored index, or returns None if there is none or it was built for other edges or weights
+def load_landmark_index(path, key):
+    try:
+        with np.load(path) as data:
+            if str(data["fingerprint"]) != key:
+                return None
+            return LandmarkIndex(data["landmarks"], data["from_landmarks"], data["to_landmarks"], key)
+    except (FileNotFoundError, ValueError, KeyError, OSError):
+        return None
+
+# Loads or builds the index of a weight and keeps it with the routing graph, and next to the graph if it has a directory
+def prepare_landmark_index(rg, weight, key):
+    try:
+        index = None
+        if rg.directory is not None:
+            index = load_landmark_index(index_path(rg.directory, key), key)
+        if index is None:
+            with metrics.timer("landmark_index"):
+                index = build_landmark_index(rg, weight)
+            if rg.directory is not None and os.path.isdir(rg.directory):
+                save_landmark_index(index, index_path(rg.directory, key))
+        rg.landmarks[key] = index
+    finally:
+        with rg.landmarks_lock:
+            rg.landmarks_building.discard(key)
+
+# Returns the landmark index of a weight of the routing graph if it is ready. Otherwise it is loaded or built in a
+# background thread and None is returned, so the caller can use plain Dijkstra searches meanwhile.
+# Indexes are looked up by the fingerprint of the edges and weights, so a changed graph or preference gets a new index
+def get_landmark_index(rg, weight, background=True):
+    if not LANDMARKS_ENABLED or rg.number_of_nodes == 0:
+        return None
+    key = rg.landmark_keys.get(weight)
+    if key is None:
+        key = fingerprint(rg, weight)
+        rg.landmark_keys[weight] = key
+
+    index = rg.landmarks.get(key)
+    if index is not None:
+        return index
+    if background and not BACKGROUND_BUILDS:
+        return None
+    with rg.landmarks_lock:
+        if key in rg.landmarks_building:
+            return None
+        rg.landmarks_building.add(key)
+
+    if not background:
+        prepare_landmark_index(rg, weight, key)
+        return rg.landmarks.get(key)
+    threading.Thread(target=prepare_landmark_index, args=(rg, weight, key), daemon=True, name="landmark-index").start()
+    return None
+
+# A* search from the source to the target index, guided by the lower bounds of the landmark index.
+# Returns the shortest path as node indices
+def astar_path(rg, source, target, weight, index):
+    metrics.count("astar_searches")
+    with metrics.timer("astar"):
+        matrix, _ = rg.get_adjacency(weight)
+        indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+        bound = index.lower_bound(target)
+
+        inf = float("inf")
+        distances = {source: 0.0}
+        predecessors = {source: None}
+        done = set()
+        heap = [(bound(source), source)]
+        while heap:
+            _, u = heapq.heappop(heap)
+            if u == target:
+                break
+            if u in done:
+                continue
+            done.add(u)
+
+            distance = distances[u]
+            start, end = indptr[u], indptr[u+1]
+            for v, length in zip(indices[start:end].tolist(), data[start:end].tolist()):
+                candidate = distance + length
+                if candidate < distances.get(v, inf):
+                    distances[v] = candidate
+                    predecessors[v] = u
+                    heapq.heappush(heap, (candidate + bound(v), v))
+        else:
+            raise NetworkXNoPath(f"No path between {source} and {target}")
+
+        path = [target]
+        while predecessors[path[-1]] is not None:
+            path.append(predecessors[path[-1]])
+        path.reverse()
+        return path
@@ -0,0 +1,99 @@
+import os
+import resource
+import threading
+import contextvars
+from contextlib import contextmanager
+import metrics
+
+# Routes of this length in meters and longer are prepared in the bounded-memory mode. Set MEMORY_BOUNDED=1 to use it for all routes
+MEMORY_BOUNDED_DISTANCE = float(os.environ.get("MEMORY_BOUNDED_DISTANCE", 21000))
+MEMORY_BOUNDED = os.environ.get("MEMORY_BOUNDED", "").lower() in ("1", "true", "yes")
+
+# Memory in bytes the graphs being prepared at the same time may use together. Unset does not enforce a budget
+MEMORY_BUDGET = int(os.environ["MEMORY_BUDGET"]) if os.environ.get("MEMORY_BUDGET") else None
+
+# Estimated bytes per node and edge of the stitched graph for preparing it: the networkx graph and its simplified copy,
+# the edge store, the layers and the routing arrays
+NODE_BYTES = int(os.environ.get("MEMORY_NODE_BYTES", 1000))
+EDGE_BYTES = int(os.environ.get("MEMORY_EDGE_BYTES", 2000))
+
+# Histogram buckets of the memory in bytes
+MEMORY_BUCKETS = [2 ** 27, 2 ** 28, 2 ** 29, 2 ** 30, 2 ** 31, 2 ** 32, 2 ** 33]
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+# Returns whether the graph of a route of this length is prepared in the bounded-memory mode
+def is_bounded(route_length):
+    return MEMORY_BOUNDED or route_length >= MEMORY_BOUNDED_DISTANCE
+
+# Returns the resident memory of the process in bytes, or None if it can not be read
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Returns the peak resident memory of the process in bytes, from the high water mark of the kernel or else from
+# the maximum resident size of getrusage
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def estimate_graph_bytes(nodes, edges):
+    return nodes * NODE_BYTES + edges * EDGE_BYTES
+
+# Estimated memory of the graphs being prepared, by request
+reservations = dict()
+reservations_lock = threading.Lock()
+current_reservation = contextvars.ContextVar("current_reservation", default=None)
+
+# Tracks the estimated memory of the graph prepared in the block, so each request is only checked against the budget
+# left by the other requests preparing graphs at the same time. The reservation is released when the block ends
+@contextmanager
+def reservation():
+    key = object()
+    token = current_reservation.set(key)
+    with reservations_lock:
+        reservations[key] = 0
+    try:
+        yield
+    finally:
+        with reservations_lock:
+            del reservations[key]
+        current_reservation.reset(token)
+
+# Records the estimated memory of preparing a graph of nodes and edges after a stage of the preparation, and raises
+# MemoryBudgetExceeded if it does not fit in the budget next to the other graphs being prepared. Stages check the graph
+# while it grows (e.g. after each stitched tile), so a request is stopped before it allocates the rest of its graph
+def check_budget(stage, nodes, edges, budget=None):
+    if budget is None:
+        budget = MEMORY_BUDGET
+
+    estimate = estimate_graph_bytes(nodes, edges)
+    key = current_reservation.get()
+    with reservations_lock:
+        if key is not None:
+            reservations[key] = max(reservations[key], estimate)
+            others = sum(reserved for other, reserved in reservations.items() if other is not key)
+        else:
+            others = sum(reservations.values())
+    metrics.observe("graph_bytes", estimate, MEMORY_BUCKETS, stage=stage)
+    rss = current_rss()
+    if rss is not None:
+        metrics.observe("rss_bytes", rss, MEMORY_BUCKETS, stage=stage)
+    metrics.observe("peak_rss_bytes", peak_rss(), MEMORY_BUCKETS, stage=stage)
+
+    if budget is not None and others + estimate > budget:
+        metrics.count("memory_budget_exceeded", stage=stage)
+        raise MemoryBudgetExceeded(f"Preparing the graph needs about {estimate / 2**20:.0f} MB after {stage}, and "
+                                   f"{others / 2**20:.0f} MB of the budget of {budget / 2**20:.0f} MB is used by other requests")
+    return estimate
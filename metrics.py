@@ -0,0 +1,122 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Prefix of the metric names in the Prometheus output
+METRIC_PREFIX = "running_routes"
+
+# Histogram buckets of the stage timers in seconds, and of the graph sizes in nodes or edges
+TIME_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+SIZE_BUCKETS = [100, 1000, 10000, 50000, 100000, 500000, 1000000]
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+# Counters and histograms of all requests handled by this process, by (name, labels)
+counters = dict()
+histograms = dict()
+metrics_lock = threading.Lock()
+
+# Breakdown of the request being handled in the current thread, set by trace
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+# Adds to a counter, and to the counts of the current request
+def count(name, value=1, **labels):
+    with metrics_lock:
+        key = (name, labels_key(labels))
+        counters[key] = counters.get(key, 0) + value
+
+    breakdown = current_trace.get()
+    if breakdown is not None:
+        breakdown["counts"][name] = breakdown["counts"].get(name, 0) + value
+
+# Adds a value to a histogram, and records it for the current request
+def observe(name, value, buckets=SIZE_BUCKETS, **labels):
+    with metrics_lock:
+        key = (name, labels_key(labels))
+        if key not in histograms:
+            histograms[key] = Histogram(buckets)
+        histograms[key].observe(value)
+
+    breakdown = current_trace.get()
+    if breakdown is not None:
+        breakdown["values"][name] = value
+
+# Times the block as a stage. Stages run several times in a request (e.g. shortest path searches) add up in the breakdown
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with metrics_lock:
+            key = ("stage_seconds", (("stage", stage),))
+            if key not in histograms:
+                histograms[key] = Histogram(TIME_BUCKETS)
+            histograms[key].observe(elapsed)
+
+        breakdown = current_trace.get()
+        if breakdown is not None:
+            breakdown["timings"][stage] = breakdown["timings"].get(stage, 0) + elapsed * 1000
+
+# Collects the timings (in milliseconds), counts and values recorded while handling a request in the block
+@contextmanager
+def trace():
+    breakdown = {"timings": dict(), "counts": dict(), "values": dict()}
+    token = current_trace.set(breakdown)
+    start = time.perf_counter()
+    try:
+        yield breakdown
+    finally:
+        breakdown["timings"]["total"] = (time.perf_counter() - start) * 1000
+        breakdown["timings"] = {stage: round(ms, 3) for stage, ms in breakdown["timings"].items()}
+        current_trace.reset(token)
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+# Returns all metrics in the Prometheus text exposition format
+def render():
+    lines = []
+    with metrics_lock:
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f"{METRIC_PREFIX}_{name}_total{format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} histogram")
+            for (histogram_name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f"{METRIC_PREFIX}_{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{METRIC_PREFIX}_{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{METRIC_PREFIX}_{name}_count{format_labels(labels)} {histogram.count}")
+
+    return "\n".join(lines) + "\n"
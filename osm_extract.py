@@ -0,0 +1,364 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+from xml.sax.saxutils import quoteattr
+import numpy as np
+import networkx as nx
+import geopandas as gpd
+import osmnx as ox
+import tile_cache
+import feature_store
+from graph import combine_tags, NATURE_TAGS, TOURISM_TAGS, VIEWPOINT_TAGS
+
+# Tags of the features stored for every tile
+FEATURE_TAGS = combine_tags([NATURE_TAGS, TOURISM_TAGS, VIEWPOINT_TAGS])
+
+# Highway values left out of the network, the same as the "all" network type of OSMnx
+EXCLUDED_HIGHWAYS = {"abandoned", "construction", "no", "planned", "platform", "proposed", "raceway", "razed", "rest_area", "services"}
+
+# Fingerprints of the tiles written from each extract, so a refresh only rewrites the tiles that changed
+def manifest_path():
+    return os.path.join(tile_cache.CACHE_DIR, "extracts.json")
+
+def load_manifest():
+    try:
+        with open(manifest_path()) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return dict()
+
+def save_manifest(manifest):
+    os.makedirs(tile_cache.CACHE_DIR, exist_ok=True)
+    tmp_path = f"{manifest_path()}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path())
+
+# Tiles per side of the square regions an extract is split into. The network and features of one region are loaded
+# at a time, so the memory used does not grow with the size of the extract
+REGION_TILES = int(os.environ.get("EXTRACT_REGION_TILES", 25))
+
+# Degrees around a region of which the ways are read as well, so the edges leaving its tiles are complete
+REGION_MARGIN = 0.01
+
+# Characters of OSM XML kept in memory before they are appended to the region files
+FLUSH_CHARS = 2 ** 24
+
+# Relation types OSMnx builds feature geometries for
+FEATURE_RELATION_TYPES = {"multipolygon", "boundary"}
+
+# OSM XML element names of the relation member types of pyosmium
+MEMBER_TYPES = {"n": "node", "w": "way", "r": "relation"}
+
+def import_osmium():
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError("Reading .osm and .osm.pbf extracts requires pyosmium, install it with: pip install osmium")
+    return osmium
+
+def is_network_way(tags):
+    return "highway" in tags and tags["highway"] not in EXCLUDED_HIGHWAYS and tags.get("area") != "yes"
+
+def is_feature(tags):
+    return any(key in tags for key in FEATURE_TAGS)
+
+def region_of(tile):
+    return tile[0] // REGION_TILES, tile[1] // REGION_TILES
+
+# Returns the regions within REGION_MARGIN of a bounding box (west, south, east, north)
+def regions_for_bbox(bbox):
+    west, south, east, north = bbox
+    min_row, min_col = region_of(tile_cache.tile_of(south - REGION_MARGIN, west - REGION_MARGIN))
+    max_row, max_col = region_of(tile_cache.tile_of(north + REGION_MARGIN, east + REGION_MARGIN))
+    return [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+
+def region_path(directory, region, kind):
+    return os.path.join(directory, f"{kind}_{region[0]}_{region[1]}.osm")
+
+def tags_xml(tags):
+    return "".join(f"<tag k={quoteattr(k)} v={quoteattr(v)}/>" for k, v in tags.items())
+
+def node_xml(node_id, lat, lon, tags=None):
+    if tags:
+        return f'<node id="{node_id}" lat="{lat:.7f}" lon="{lon:.7f}">{tags_xml(tags)}</node>\n'
+    return f'<node id="{node_id}" lat="{lat:.7f}" lon="{lon:.7f}"/>\n'
+
+# Returns the OSM XML of a way and its nodes
+def way_xml(way_id, nodes, tags):
+    refs = "".join(f'<nd ref="{ref}"/>' for ref, _, _ in nodes)
+    return "".join(node_xml(*node) for node in nodes) + f'<way id="{way_id}">{refs}{tags_xml(tags)}</way>\n'
+
+def relation_xml(relation_id, members, tags):
+    members = "".join(f'<member type="{kind}" ref="{ref}" role={quoteattr(role)}/>' for kind, ref, role in members)
+    return f'<relation id="{relation_id}">{members}{tags_xml(tags)}</relation>\n'
+
+def union_bbox(bbox, other):
+    if bbox is None:
+        return other
+    return min(bbox[0], other[0]), min(bbox[1], other[1]), max(bbox[2], other[2]), max(bbox[3], other[3])
+
+# Appends OSM XML to the network and features files of the regions, keeping at most FLUSH_CHARS in memory
+class RegionFiles:
+    def __init__(self, directory, regions=None):
+        self.directory = directory
+        self.regions = regions
+        self.buffers = dict()
+        self.buffered = 0
+        self.paths = set()
+
+    def add(self, regions, kind, text):
+        for region in regions:
+            if self.regions is not None and region not in self.regions:
+                continue
+            path = region_path(self.directory, region, kind)
+            if path not in self.paths:
+                self.paths.add(path)
+                self.buffers.setdefault(path, []).append("<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\">\n")
+            self.buffers.setdefault(path, []).append(text)
+            self.buffered += len(text)
+        if self.buffered > FLUSH_CHARS:
+            self.flush()
+
+    def flush(self):
+        for path, parts in self.buffers.items():
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("".join(parts))
+        self.buffers = dict()
+        self.buffered = 0
+
+    def close(self):
+        for path in self.paths:
+            self.buffers.setdefault(path, []).append("</osm>\n")
+        self.flush()
+
+# Returns the bounding box in the header of an extract, or None if it has none
+def header_bbox(osmium, path):
+    reader = osmium.io.Reader(path, osmium.osm.osm_entity_bits.NOTHING)
+    try:
+        box = reader.header().box()
+    finally:
+        reader.close()
+    if not box.valid():
+        return None
+    return box.bottom_left.lon, box.bottom_left.lat, box.top_right.lon, box.top_right.lat
+
+# Splits an .osm or .osm.pbf extract into an OSM XML file of the walkable network and one of the features for each
+# region, as graph_from_xml and features_from_xml read every element of a file. Ways are written with their nodes to
+# every region they come within REGION_MARGIN of, and relations with their member ways to every region of the members.
+# Only the regions in regions are written, if given. Returns the bounding box of the network
+def split_extract(path, directory, regions=None):
+    osmium = import_osmium()
+    # Node locations are kept in a file instead of in memory
+    index = f"sparse_file_array,{os.path.join(directory, 'locations.idx')}"
+
+    def way_nodes(way):
+        nodes = [(node.ref, node.location.lat, node.location.lon) for node in way.nodes if node.location.valid()]
+        if not nodes:
+            return nodes, None
+        lats = [lat for _, lat, _ in nodes]
+        lons = [lon for _, _, lon in nodes]
+        return nodes, (min(lons), min(lats), max(lons), max(lats))
+
+    # The relations come after their member ways, so the member ways of feature relations and the extent of the
+    # relations are found first
+    relation_ways = dict()
+    relation_bboxes = dict()
+
+    class FeatureRelations(osmium.SimpleHandler):
+        def relation(self, relation):
+            tags = {tag.k: tag.v for tag in relation.tags}
+            if tags.get("type") in FEATURE_RELATION_TYPES and is_feature(tags):
+                relation_bboxes[relation.id] = None
+                for member in relation.members:
+                    if member.type == "w":
+                        relation_ways.setdefault(member.ref, []).append(relation.id)
+
+    class RelationExtents(osmium.SimpleHandler):
+        def way(self, way):
+            if way.id in relation_ways:
+                _, bbox = way_nodes(way)
+                if bbox is not None:
+                    for relation_id in relation_ways[way.id]:
+                        relation_bboxes[relation_id] = union_bbox(relation_bboxes[relation_id], bbox)
+
+    FeatureRelations().apply_file(path)
+    if relation_ways:
+        RelationExtents().apply_file(path, locations=True, idx=index)
+
+    files = RegionFiles(directory, regions)
+    extent = None
+
+    class Regions(osmium.SimpleHandler):
+        def node(self, node):
+            if len(node.tags) and node.location.valid():
+                tags = {tag.k: tag.v for tag in node.tags}
+                if is_feature(tags):
+                    lat, lon = node.location.lat, node.location.lon
+                    files.add(regions_for_bbox((lon, lat, lon, lat)), "features", node_xml(node.id, lat, lon, tags))
+
+        def way(self, way):
+            nonlocal extent
+            tags = {tag.k: tag.v for tag in way.tags}
+            network = is_network_way(tags)
+            feature = is_feature(tags)
+            relations = relation_ways.get(way.id, ())
+            if not (network or feature or relations):
+                return
+            nodes, bbox = way_nodes(way)
+            if bbox is None:
+                return
+
+            if network:
+                extent = union_bbox(extent, bbox)
+                files.add(regions_for_bbox(bbox), "network", way_xml(way.id, nodes, tags))
+            feature_regions = set(regions_for_bbox(bbox)) if feature else set()
+            for relation_id in relations:
+                if relation_bboxes[relation_id] is not None:
+                    feature_regions.update(regions_for_bbox(relation_bboxes[relation_id]))
+            files.add(sorted(feature_regions), "features", way_xml(way.id, nodes, tags))
+
+        def relation(self, relation):
+            bbox = relation_bboxes.get(relation.id)
+            if bbox is not None:
+                members = [(MEMBER_TYPES[member.type], member.ref, member.role) for member in relation.members]
+                files.add(regions_for_bbox(bbox), "features", relation_xml(relation.id, members, {tag.k: tag.v for tag in relation.tags}))
+
+    try:
+        Regions().apply_file(path, locations=True, idx=index)
+    finally:
+        files.close()
+    return extent
+
+# Reads the network of an OSM XML file as an unsimplified graph, like a downloaded tile
+def read_network(network_path):
+    if not os.path.exists(network_path):
+        return nx.MultiDiGraph(crs="epsg:4326")
+    try:
+        with tile_cache.network_tags():
+            G = ox.graph_from_xml(network_path, simplify=False, retain_all=True)
+    except ValueError:
+        return nx.MultiDiGraph(crs="epsg:4326")
+    return G
+
+def read_features(features_path):
+    features = None
+    if os.path.exists(features_path):
+        try:
+            features = ox.features_from_xml(features_path, tags=FEATURE_TAGS)
+        except ValueError:
+            features = None
+    if features is None or features.empty:
+        return gpd.GeoDataFrame(geometry=[], crs="epsg:4326")
+    return features
+
+def graph_fingerprint(G):
+    digest = hashlib.sha1()
+    for node, data in sorted(G.nodes(data=True)):
+        digest.update(repr((node, data["x"], data["y"])).encode())
+    for u, v, k, data in sorted(G.edges(keys=True, data=True), key=lambda edge: edge[:3]):
+        attributes = sorted((name, value.wkb_hex if name == "geometry" else repr(value)) for name, value in data.items())
+        digest.update(repr((u, v, k, attributes)).encode())
+    return digest.hexdigest()
+
+def features_fingerprint(features):
+    digest = hashlib.sha1()
+    for index, row in features.sort_index().iterrows():
+        digest.update(repr((index, sorted((name, value.wkb_hex if name == "geometry" else repr(value)) for name, value in row.items()))).encode())
+    return digest.hexdigest()
+
+# Returns the features overlapping each tile, with the tag columns none of them has left out, so the features of a tile
+# do not depend on the rest of the region they were read with
+def split_features(features, tiles):
+    bounds = features.geometry.bounds.to_numpy() if not features.empty else np.zeros((0, 4))
+    tile_features = dict()
+    for tile in tiles:
+        west, south, east, north = tile_cache.tile_bbox(tile)
+        overlaps = (bounds[:, 0] <= east) & (bounds[:, 2] >= west) & (bounds[:, 1] <= north) & (bounds[:, 3] >= south)
+        selected = features[overlaps]
+        tile_features[tile] = selected[[name for name in selected.columns if name == "geometry" or selected[name].notna().any()]]
+    return tile_features
+
+# Returns whether the tile and features of a tile name in the manifest are stored
+def is_stored(name):
+    tile = tuple(int(value) for value in name.split("_"))
+    return os.path.exists(tile_cache.tile_path(tile)) and os.path.exists(feature_store.feature_path(tile))
+
+# Builds the tiles and feature stores of all tiles overlapping an .osm or .osm.pbf extract, or only those overlapping
+# bbox (west, south, east, north). The extract is split into regions while it is read, and the tiles of one region are
+# built at a time. Tiles and features that are the same as the last time the extract was ingested are not written
+# again, so the elevation data, snapping indexes and packed graphs of unchanged areas are kept.
+# Returns the number of tiles in the extract and the number of tile and feature files written
+def ingest_extract(path, bbox=None, refresh=False):
+    path = os.path.abspath(path)
+    manifest = load_manifest()
+    previous = manifest.get(path, dict())
+    stat = os.stat(path)
+    # An unchanged extract is only skipped if all of its tiles and features are still in the cache
+    if (refresh and previous.get("mtime") == stat.st_mtime and previous.get("size") == stat.st_size
+            and previous.get("bbox") == (list(bbox) if bbox else None) and all(map(is_stored, previous.get("tiles", {})))):
+        return {"tiles": len(previous.get("tiles", {})), "tiles_written": 0, "features_written": 0}
+
+    previous_tiles = previous.get("tiles", dict())
+    fingerprints = dict()
+    with tempfile.TemporaryDirectory(prefix="osm-extract-") as directory:
+        if bbox:
+            tiles = tile_cache.tiles_for_bbox(bbox)
+            extent = split_extract(path, directory, {region_of(tile) for tile in tiles})
+        else:
+            extent = split_extract(path, directory)
+            extent = header_bbox(import_osmium(), path) or extent
+            if extent is None:
+                raise ValueError("The extract has no bounds and no network")
+            tiles = tile_cache.tiles_for_bbox(extent)
+        written = {"tiles": len(tiles), "tiles_written": 0, "features_written": 0}
+
+        region_tiles = dict()
+        for tile in tiles:
+            region_tiles.setdefault(region_of(tile), []).append(tile)
+        for region, tiles_of_region in sorted(region_tiles.items()):
+            G = read_network(region_path(directory, region, "network"))
+            features = read_features(region_path(directory, region, "features"))
+            tile_graphs = tile_cache.split_graph(G, tiles_of_region)
+            tile_features = split_features(features, tiles_of_region)
+            for tile in tiles_of_region:
+                name = f"{tile[0]}_{tile[1]}"
+                graph_print = graph_fingerprint(tile_graphs[tile])
+                features_print = features_fingerprint(tile_features[tile])
+                fingerprints[name] = {"graph": graph_print, "features": features_print}
+                unchanged = previous_tiles.get(name, dict())
+
+                if unchanged.get("graph") != graph_print or not os.path.exists(tile_cache.tile_path(tile)):
+                    tile_cache.save_tile(tile, tile_graphs[tile])
+                    tile_cache.remove_companions(tile)
+                    written["tiles_written"] += 1
+                else:
+                    # Mark the tile as fresh, keeping the attributes stored in it
+                    os.utime(tile_cache.tile_path(tile))
+
+                if unchanged.get("features") != features_print or not os.path.exists(feature_store.feature_path(tile)):
+                    feature_store.save_tile_features(tile, tile_features[tile])
+                    written["features_written"] += 1
+                else:
+                    os.utime(feature_store.feature_path(tile))
+
+    manifest[path] = {"mtime": stat.st_mtime, "size": stat.st_size, "bbox": list(bbox) if bbox else None,
+                      "ingested": time.time(), "tiles": fingerprints}
+    save_manifest(manifest)
+    return written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the graph tiles and feature stores from local .osm or .osm.pbf extracts")
+    parser.add_argument("extracts", nargs="+", help="Paths of the extracts")
+    parser.add_argument("--bbox", help="Only ingest the tiles overlapping west,south,east,north")
+    parser.add_argument("--refresh", action="store_true", help="Skip extracts that did not change since they were last ingested")
+    args = parser.parse_args()
+
+    bbox = tuple(float(value) for value in args.bbox.split(",")) if args.bbox else None
+    for extract in args.extracts:
+        result = ingest_extract(extract, bbox, args.refresh)
+        print(f"Ingested {extract}: {result['tiles']} tiles, {result['tiles_written']} tiles and "
+              f"{result['features_written']} feature sets written")
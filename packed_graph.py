@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import shutil
+import threading
+import numpy as np
+from scipy.sparse import csr_matrix
+import metrics
+from edge_store import EdgeStore, get_edge_store, NODE_COLUMNS, EDGE_COLUMNS
+from routing_core import get_routing_graph, build_routing_graph, get_distance_field
+from graph import weights_approx_alg, weights_heuristic, add_layers, store_extent, LAYERS, LAYER_COLUMNS
+
+# Directory with the packed graphs, an empty value disables them. Packed graphs older than the maximum age are not used
+PACKED_GRAPH_DIR = os.environ.get("PACKED_GRAPH_DIR", os.path.join("cache", "packed"))
+PACKED_GRAPH_MAX_AGE = float(os.environ.get("PACKED_GRAPH_MAX_AGE", 7 * 24 * 3600))
+
+FORMAT_VERSION = 1
+
+# A prepared graph backed by arrays, which the routing and postprocess functions accept in place of a networkx graph.
+# Like a networkx graph it keeps the edge store and the routing graph in its graph attributes
+class PackedGraph:
+    def __init__(self, store, adjacency, path=None):
+        self.graph = {"edge_store": store}
+        self.adjacency = adjacency
+        self.path = path
+
+        # Landmark indexes of the preferences routed on this graph, shared by the graphs returned by with_preferences
+        self.landmarks = dict()
+        self.landmarks_building = set()
+        self.landmarks_lock = threading.Lock()
+
+        # Held while layers are added, so concurrent requests compute a missing layer once
+        self.layers_lock = threading.Lock()
+
+        # Distance fields by the center and radius the graph was prepared for, see center_field
+        self.center_fields = dict()
+
+    @property
+    def layers(self):
+        return self.graph["edge_store"].layers
+
+    def number_of_nodes(self):
+        return len(self.graph["edge_store"].nodes)
+
+    def number_of_edges(self):
+        return self.graph["edge_store"].number_of_edges
+
+    # Returns a graph sharing the arrays of this one, with the edge weights of the preferences
+    def with_preferences(self, pref):
+        store = self.graph["edge_store"].view()
+        store.cache["weight_approx_alg"] = weights_approx_alg(store, pref)
+        store.cache["weight_heuristic"] = weights_heuristic(store, pref)
+
+        P = PackedGraph(store, self.adjacency, self.path)
+        rg = get_routing_graph(P)
+        rg.adjacency.update(self.adjacency)
+        rg.landmarks = self.landmarks
+        rg.landmarks_building = self.landmarks_building
+        rg.landmarks_lock = self.landmarks_lock
+        rg.directory = self.path
+        return P
+
+    # Returns the distance field of the center of a graph prepared for routes of radius, for finding the start vertices
+    # it covers. It is computed on the lengths once per opened graph, as every request near a warm spot asks for it
+    def center_field(self, center, radius):
+        field = self.center_fields.get((center, radius))
+        if field is None:
+            store = self.graph["edge_store"]
+            rg = build_routing_graph(store, {"length": store.length})
+            rg.adjacency.update(self.adjacency)
+            field = get_distance_field(rg, center, "length", limit=radius / 2)
+            self.center_fields[(center, radius)] = field
+        return field
+
+    # Adds the layers the graph is missing to its edge store in place, and stores them with the graph.
+    # The features of the new layers are retrieved for the area of all the nodes, as the graph may have been prepared
+    # around another start point. Returns the layers added
+    def add_layers(self, layers):
+        if all(layer in self.layers for layer in layers):
+            return []
+        with self.layers_lock:
+            store = self.graph["edge_store"]
+            start_point, route_length = store_extent(store)
+            added = add_layers(store, layers, start_point, route_length)
+            if added and self.path is not None:
+                with metrics.timer("packed_graph_save"):
+                    save_layers(self, added)
+        return added
+
+# Returns a packed graph sharing the edge store and length adjacency of a prepared networkx graph.
+# Path is the directory the graph was saved to, if any, where its landmark indexes are stored
+def pack_graph(G, path=None):
+    rg = get_routing_graph(G)
+    adjacency = {("length", reverse): rg.get_adjacency("length", reverse) for reverse in (False, True)}
+    return PackedGraph(get_edge_store(G), adjacency, path)
+
+# Writes the edge store of a prepared graph and its length adjacency matrices as .npy files in a directory
+def write_packed_graph(G, path):
+    store = get_edge_store(G)
+    rg = get_routing_graph(G)
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(tmp_path)
+    for name, values in store.columns().items():
+        np.save(os.path.join(tmp_path, name + ".npy"), np.ascontiguousarray(values))
+
+    for reverse in (False, True):
+        matrix, edge_ids = rg.get_adjacency("length", reverse)
+        prefix = "reverse_" if reverse else "forward_"
+        for name, values in (("data", matrix.data), ("indices", matrix.indices), ("indptr", matrix.indptr), ("edge_ids", edge_ids)):
+            np.save(os.path.join(tmp_path, prefix + name + ".npy"), values)
+
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"version": FORMAT_VERSION, "nodes": int(len(store.nodes)), "edges": int(store.number_of_edges),
+                   "layers": store.layers}, f)
+
+    # Replace the directory in one step, so readers never open a partially written graph
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process wrote the same graph first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+# Opens a packed graph with all arrays memory-mapped, so processes opening the same graph share its pages
+def load_packed_graph(path):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported packed graph version {meta['version']}")
+
+    def load(name):
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+    # Graphs written before the layers were recorded have all of them
+    store = EdgeStore({name: load(name) for name in NODE_COLUMNS + EDGE_COLUMNS}, meta.get("layers", LAYERS))
+    adjacency = dict()
+    for reverse in (False, True):
+        prefix = "reverse_" if reverse else "forward_"
+        matrix = csr_matrix((load(prefix + "data"), load(prefix + "indices"), load(prefix + "indptr")),
+                            shape=(meta["nodes"], meta["nodes"]), copy=False)
+        adjacency[("length", reverse)] = (matrix, load(prefix + "edge_ids"))
+
+    return PackedGraph(store, adjacency, path)
+
+# Writes the columns of layers added to a packed graph next to its other arrays, and adds them to its meta data.
+# Each file is replaced in one step, so processes that have the old arrays mapped keep reading them
+def save_layers(packed, layers):
+    store = packed.graph["edge_store"]
+    tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    meta_path = os.path.join(packed.path, "meta.json")
+    try:
+        for layer in layers:
+            for name in LAYER_COLUMNS[layer]:
+                path = os.path.join(packed.path, name + ".npy")
+                with open(path + tmp_suffix, "wb") as f:
+                    np.save(f, np.ascontiguousarray(getattr(store, name)))
+                os.replace(path + tmp_suffix, path)
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta["layers"] = store.layers
+        modified = os.path.getmtime(meta_path)
+        with open(meta_path + tmp_suffix, "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + tmp_suffix, meta_path)
+        # Keep the time the graph was prepared, so adding layers does not extend its lifetime
+        os.utime(meta_path, (time.time(), modified))
+    except OSError:
+        # The graph was prepared again or removed meanwhile, the layers are only kept in memory
+        return
+
+    # This process already has the new layers
+    with open_graphs_lock:
+        for key, (version, opened) in list(open_graphs.items()):
+            if opened is packed:
+                open_graphs[key] = (meta_version(meta_path), packed)
+
+# Returns the time a packed graph was prepared and a version that changes when layers are added to it
+def meta_version(meta_path):
+    stat = os.stat(meta_path)
+    return stat.st_mtime, stat.st_ctime
+
+# Packed graphs opened by this process
+open_graphs = dict()
+open_graphs_lock = threading.Lock()
+
+def packed_graph_path(key):
+    return os.path.join(PACKED_GRAPH_DIR, key)
+
+# Returns the packed graph stored under a key, or None if there is none or it is too old
+def open_packed_graph(key):
+    if not PACKED_GRAPH_DIR:
+        return None
+
+    path = packed_graph_path(key)
+    try:
+        version = meta_version(os.path.join(path, "meta.json"))
+    except FileNotFoundError:
+        return None
+    if time.time() - version[0] > PACKED_GRAPH_MAX_AGE:
+        return None
+
+    with open_graphs_lock:
+        opened = open_graphs.get(key)
+        if opened is None or opened[0] != version:
+            opened = (version, load_packed_graph(path))
+            open_graphs[key] = opened
+        return opened[1]
+
+# Stores a prepared graph under a key, if packed graphs are enabled. Returns the directory it was written to, or None
+def save_packed_graph(key, G):
+    if PACKED_GRAPH_DIR and G.number_of_nodes() != 0:
+        os.makedirs(PACKED_GRAPH_DIR, exist_ok=True)
+        write_packed_graph(G, packed_graph_path(key))
+        return packed_graph_path(key)
+    return None
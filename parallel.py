@@ -0,0 +1,160 @@
+import os
+import uuid
+import atexit
+import threading
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+from routing_core import RoutingGraph
+import landmarks
+
+# Default number of worker processes for evaluating candidate routes, 1 evaluates them in the calling process
+WORKERS = int(os.environ.get("ROUTE_WORKERS", 1))
+
+# Worker processes are started from a clean server process instead of forking the request process, as a fork of a
+# process with running threads (the web server, the enrichment pool, the cache warmer) can deadlock on their locks
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+mp_context = multiprocessing.get_context(START_METHOD)
+if START_METHOD == "forkserver":
+    # The workers only need the routing modules, which the server process imports once for all of them
+    mp_context.set_forkserver_preload(["routing", "parallel"])
+
+# Process pool shared by all requests, created at startup by start_pool or else when first used
+pool = None
+pool_workers = 0
+pool_lock = threading.Lock()
+
+# In a worker process: the routing graph currently attached from shared memory and its shared memory blocks
+worker_graph_id = None
+worker_graph = None
+worker_blocks = []
+
+# Worker processes never build landmark indexes: a build on a graph attached for one request is thrown away
+def init_worker():
+    landmarks.BACKGROUND_BUILDS = False
+
+def get_pool(workers):
+    global pool, pool_workers
+    with pool_lock:
+        if pool is None or pool_workers != workers:
+            if pool is not None:
+                pool.shutdown()
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=init_worker)
+            pool_workers = workers
+        return pool
+
+# Creates the pool with the configured number of workers, if candidates are evaluated in worker processes.
+# Called once at startup, so the workers are started before the requests are handled
+def start_pool(workers=None):
+    if workers is None:
+        workers = WORKERS
+    if workers > 1:
+        get_pool(workers)
+
+@atexit.register
+def shutdown_pool():
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+# Copies an array into a new shared memory block and returns the block and a description to attach to it with
+def share_array(array):
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+# Attaches to an array shared by share_array without copying it
+def attach_array(spec):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+# Publishes the arrays of a routing graph, including the adjacency matrices of the given weights and their landmark
+# indexes that are ready, in shared memory.
+# Returns the description workers attach with, and the blocks which must be released with unpublish when done
+def publish_routing_graph(rg, weights):
+    blocks = []
+    def share(array):
+        block, spec = share_array(array)
+        blocks.append(block)
+        return spec
+
+    description = {
+        "id": uuid.uuid4().hex,
+        "nodes": share(rg.nodes),
+        "u": share(rg.u),
+        "v": share(rg.v),
+        "weights": {name: share(values) for name, values in rg.weights.items()},
+        "adjacency": [],
+        "landmarks": [],
+    }
+    for weight, reverse in weights:
+        matrix, edge_ids = rg.get_adjacency(weight, reverse)
+        arrays = {"data": share(matrix.data), "indices": share(matrix.indices), "indptr": share(matrix.indptr), "edge_ids": share(edge_ids)}
+        description["adjacency"].append((weight, reverse, arrays))
+    for weight in sorted({weight for weight, _ in weights}):
+        key = rg.landmark_keys.get(weight)
+        index = rg.landmarks.get(key)
+        if index is not None:
+            arrays = {"landmarks": share(index.landmarks), "from_landmarks": share(index.from_landmarks), "to_landmarks": share(index.to_landmarks)}
+            description["landmarks"].append((weight, key, arrays))
+
+    return description, blocks
+
+def unpublish(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+# Builds a routing graph on top of the shared arrays in a worker process. The last attached graph is kept,
+# so its distance fields are reused by all candidates evaluated in the worker
+def attach_routing_graph(description):
+    global worker_graph_id, worker_graph, worker_blocks
+    if worker_graph_id == description["id"]:
+        return worker_graph
+
+    # Release the previous graph before attaching to the new one
+    worker_graph = None
+    for block in worker_blocks:
+        block.close()
+    worker_blocks = []
+
+    def attach(spec):
+        block, array = attach_array(spec)
+        worker_blocks.append(block)
+        return array
+
+    nodes = attach(description["nodes"])
+    weights = {name: attach(spec) for name, spec in description["weights"].items()}
+    rg = RoutingGraph(nodes, weights, attach(description["u"]), attach(description["v"]))
+    for weight, reverse, arrays in description["adjacency"]:
+        matrix = csr_matrix((attach(arrays["data"]), attach(arrays["indices"]), attach(arrays["indptr"])),
+                            shape=(rg.number_of_nodes, rg.number_of_nodes), copy=False)
+        rg.adjacency[(weight, reverse)] = (matrix, attach(arrays["edge_ids"]))
+    for weight, key, arrays in description["landmarks"]:
+        rg.landmark_keys[weight] = key
+        rg.landmarks[key] = landmarks.LandmarkIndex(attach(arrays["landmarks"]), attach(arrays["from_landmarks"]),
+                                                    attach(arrays["to_landmarks"]), key)
+
+    worker_graph_id = description["id"]
+    worker_graph = rg
+    return rg
+
+def run_task(description, function, args):
+    return function(attach_routing_graph(description), *args)
+
+# Calls function(rg, *args) for each args in args_list on a pool of worker processes, with the routing graph shared
+# between them. The results are returned in the order of args_list
+def map_on_routing_graph(rg, function, args_list, weights, workers=None):
+    if workers is None:
+        workers = WORKERS
+
+    description, blocks = publish_routing_graph(rg, weights)
+    try:
+        executor = get_pool(workers)
+        chunksize = max(1, len(args_list) // (4 * workers))
+        return list(executor.map(run_task, [description] * len(args_list), [function] * len(args_list), args_list, chunksize=chunksize))
+    finally:
+        unpublish(blocks)
@@ -0,0 +1,291 @@
+import time
+import traceback
+import metrics
+import memory
+from snapping import snap_point, snap_points, NO_NODE
+from graph import retrieve_graph, enrich_layers, start_feature_retrieval, required_layers, LAYERS
+from result_cache import route_cache, route_key, ROUTE_CACHE_DISTANCE_BUCKET
+from packed_graph import open_packed_graph, save_packed_graph, pack_graph
+from routing import heuristic, greedy, anytime, ROUTE_TIME_BUDGET
+from postprocess import summarize_route, compact_response
+from hotspots import hotspots
+
+# Stages of generating a route, in the order they finish
+STAGES = ["graph", "enrichment", "routing", "postprocess"]
+
+# Error with the message and HTTP status returned to the user
+class RouteError(Exception):
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def read_preferences(elevation, surface, nature, lighting, poi):
+    pref = [0,0,0,0,0,0,0,0]
+    if elevation == "hilly":
+        pref[0] = 1
+    if elevation == "flat":
+        pref[1] = 1
+    if surface == "road":
+        pref[2] = 1
+    if surface == "trail":
+        pref[3] = 1
+    if nature == "yes":
+        pref[4] = 1
+    if lighting == "yes":
+        pref[5] = 1
+    if poi == "tourism":
+        pref[6] = 1
+    if poi == "viewpoint":
+        pref[7] = 1
+
+    return pref
+
+# Returns the enrichment layers needed by any of the preference vectors
+def layers_for(prefs):
+    return required_layers([max(values) for values in zip(*prefs)])
+
+# Reads the start point, route length and preferences of the JSON data of a route request
+def read_request(data):
+    try:
+        lat, long = data.get("coords")
+        distance = float(data.get("distance"))
+    except (AttributeError, TypeError, ValueError):
+        raise RouteError("Route requests need coords and distance", 400)
+
+    pref = read_preferences(data.get("elevation"), data.get("surface"), data.get("nature"), data.get("lighting"), data.get("poi"))
+    return lat, long, distance, pref
+
+# Returns the seconds a route request may take, or None to run the heuristic without a deadline
+def read_time_budget(data):
+    try:
+        time_budget = data.get("timeBudget")
+        return float(time_budget) if time_budget is not None else ROUTE_TIME_BUDGET
+    except (TypeError, ValueError):
+        raise RouteError("timeBudget must be a number of seconds", 400)
+
+# Converts a response to the format asked for in the route request, and adds the report of an anytime search.
+# Responses are cached in the default format
+def format_response(response, data, search=None):
+    if data.get("format") == "compact":
+        response = compact_response(response)
+    if search is not None:
+        response = dict(response, search=search)
+    return response
+
+def packed_graph_key(start_vertex, distance):
+    return f"{start_vertex}_{round(distance / ROUTE_CACHE_DISTANCE_BUCKET)}"
+
+# The graph holds every node within radius / 2 of the center, so a start vertex whose routes stay within
+# distance / 2 of it can be routed on the same graph when its distance from the center is small enough
+def covers(field, radius, start_vertex, distance):
+    return start_vertex in field.rg.node_index and field.distance(start_vertex) + distance / 2 <= radius / 2
+
+# Returns the graph of a warm spot near the start point that covers routes of distance from the start vertex, or None
+def find_warm_graph(start_vertex, lat, long, distance):
+    for spot in hotspots.warm_spots(lat, long, distance):
+        packed = open_packed_graph(spot["packedKey"])
+        if packed is not None and covers(packed.center_field(spot["center"], spot["preparedDistance"]), spot["preparedDistance"], start_vertex, distance):
+            return packed
+    return None
+
+# Returns the prepared graph for routes of a given length from a start vertex with the enrichment layers, without weights.
+# A graph prepared earlier for the same start vertex and route length, or for a warm spot nearby, is opened from disk
+# with its layers, and only the layers it is missing are added to it. With refresh=True the graph is prepared again
+def get_prepared_graph(start_vertex, lat, long, distance, progress, layers=None, refresh=False):
+    if layers is None:
+        layers = LAYERS
+    packed_key = packed_graph_key(start_vertex, distance)
+    packed = None
+    if not refresh:
+        with metrics.timer("packed_graph_open"):
+            packed = open_packed_graph(packed_key)
+            if packed is None:
+                packed = find_warm_graph(start_vertex, lat, long, distance)
+                if packed is not None:
+                    metrics.count("warm_graph_hits")
+        metrics.count("packed_graph_hits" if packed is not None else "packed_graph_misses")
+    try:
+        if packed is None:
+            # The memory of the graph counts against the budget until it is packed
+            with memory.reservation():
+                # The features are retrieved while the graph is downloaded
+                features = start_feature_retrieval((lat, long), distance, layers)
+                with metrics.timer("graph_retrieval"):
+                    G = retrieve_graph((lat, long), distance, start_vertex)
+                if start_vertex not in G.nodes:
+                    raise ValueError("Start vertex is not in the graph")
+                progress("graph")
+                metrics.observe("graph_nodes", G.number_of_nodes())
+                metrics.observe("graph_edges", G.number_of_edges())
+
+                with metrics.timer("enrichment"):
+                    G = enrich_layers(G, lat, long, distance, layers, features)
+                with metrics.timer("packed_graph_save"):
+                    packed = pack_graph(G, save_packed_graph(packed_key, G))
+        else:
+            progress("graph")
+            with metrics.timer("enrichment"):
+                packed.add_layers(layers)
+        progress("enrichment")
+        return packed
+    except memory.MemoryBudgetExceeded as e:
+        metrics.count("route_errors", stage="graph")
+        raise RouteError(f"{e}, try a shorter route", 503)
+    except Exception as e:
+        traceback.print_exc()
+        metrics.count("route_errors", stage="graph")
+        raise RouteError("No paths near start point, try changing startpoint")
+
+# Generates a route on a graph with the weights of the preferences and returns the response data, and the report of
+# the anytime search if the route has a time budget. The budget runs from start_time if given, e.g. the start of the
+# request, and the report includes the time used until the route is postprocessed
+def route_on_graph(G, start_vertex, distance, progress, time_budget=None, start_time=None):
+    if start_time is None:
+        start_time = time.perf_counter()
+    try:
+        search = None
+        with metrics.timer("routing"):
+            if time_budget is not None:
+                metrics.count("anytime_searches")
+                route, search = anytime(G, start_vertex, distance, [], time_budget, start_time=start_time)
+            else:
+                route = heuristic(G, start_vertex, distance, [])
+
+            if len(route) == 1:
+                metrics.count("greedy_fallbacks")
+                with metrics.timer("greedy"):
+                    route = greedy(G, start_vertex, distance)
+        progress("routing")
+
+        with metrics.timer("postprocess"):
+            summary = summarize_route(G, route, distance)
+        route_coords = summary["coordinates"]
+
+        route_stats = summary["statistics"]
+        length = route_stats.get("length", 0)
+        elevation = route_stats.get("elevation", 0)
+        elevation_of_route = summary["elevation_of_route"]
+        progress("postprocess")
+        if search is not None:
+            used = time.perf_counter() - start_time
+            search = dict(search, used=used, budgetUsed=used / time_budget if time_budget > 0 else 1)
+
+        return {"route": route_coords,
+                "length": length,
+                "elevation": elevation,
+                "elevationOfRoute": elevation_of_route}, search
+    except Exception as e:
+        metrics.count("route_errors", stage="routing")
+        raise RouteError(str(e))
+
+# Generates a route for the JSON data of a route request and returns the response data.
+# The optional progress function is called with the name of each stage in STAGES when it is finished
+def generate_route(data, progress=None):
+    if progress is None:
+        progress = lambda stage: None
+    start_time = time.perf_counter()
+
+    lat, long, distance, pref = read_request(data)
+    time_budget = read_time_budget(data)
+    metrics.count("requests")
+
+    # The start point is snapped with the index stored next to the cached tiles, so cached routes and packed graphs
+    # are found without building the graph
+    try:
+        with metrics.timer("snap"):
+            start_vertex = snap_point(lat, long)
+    except Exception as e:
+        traceback.print_exc()
+        metrics.count("route_errors", stage="snap")
+        raise RouteError("No paths near start point, try changing startpoint")
+    hotspots.record(start_vertex, lat, long, distance, pref)
+
+    # Routes from the same start vertex with similar length and the same preferences are reused
+    key = route_key(start_vertex, distance, pref)
+    response = route_cache.get(key)
+    metrics.count("route_cache_hits" if response is not None else "route_cache_misses")
+    if response is not None:
+        for stage in STAGES:
+            progress(stage)
+        return format_response(response, data)
+
+    # Only the layers and weights of the preferences are calculated on the prepared graph
+    packed = get_prepared_graph(start_vertex, lat, long, distance, progress, required_layers(pref))
+    with metrics.timer("weights"):
+        G = packed.with_preferences(pref)
+    # The time budget covers the whole request, the search gets what is left of it
+    response, search = route_on_graph(G, start_vertex, distance, progress, time_budget, start_time)
+
+    # Routes of searches stopped before evaluating the candidates of the heuristic are not reused for other requests
+    if search is None or search["complete"]:
+        route_cache.put(key, response)
+    return format_response(response, data, search)
+
+# Generates routes for a list of route requests, yielding (position, response) for each request as it finishes,
+# or (position, RouteError) for requests that fail. Requests are grouped by area: a graph is prepared once around the
+# start vertex of the longest route left, and every request that fits inside it is routed on that graph
+def generate_routes(requests):
+    progress = lambda stage: None
+    pending = dict()
+
+    parsed = []
+    for position, data in enumerate(requests):
+        try:
+            read_time_budget(data)
+            parsed.append((position, read_request(data)))
+        except RouteError as e:
+            yield position, e
+
+    # Snap all start points at once
+    metrics.count("requests", len(parsed))
+    with metrics.timer("snap"):
+        start_vertices, _ = snap_points([lat for _, (lat, _, _, _) in parsed], [long for _, (_, long, _, _) in parsed])
+    for (position, (lat, long, distance, pref)), start_vertex in zip(parsed, start_vertices.tolist()):
+        if start_vertex == NO_NODE:
+            metrics.count("route_errors", stage="snap")
+            yield position, RouteError("No paths near start point, try changing startpoint")
+            continue
+        hotspots.record(start_vertex, lat, long, distance, pref)
+
+        response = route_cache.get(route_key(start_vertex, distance, pref))
+        metrics.count("route_cache_hits" if response is not None else "route_cache_misses")
+        if response is not None:
+            yield position, format_response(response, requests[position])
+            continue
+        pending.setdefault(start_vertex, []).append((position, lat, long, distance, pref))
+
+    while pending:
+        center = max(pending, key=lambda vertex: max(member[3] for member in pending[vertex]))
+        _, lat, long, radius, _ = max(pending[center], key=lambda member: member[3])
+        try:
+            # The graph gets the layers of all the requests left, as it may be shared by any of them
+            layers = layers_for([member[4] for members in pending.values() for member in members])
+            packed = get_prepared_graph(center, lat, long, radius, progress, layers)
+        except RouteError as e:
+            for position, *_ in pending.pop(center):
+                yield position, e
+            continue
+
+        # Other start vertices are routed on the same graph if it covers their longest route
+        graphs = dict()
+        field = None
+        for start_vertex in list(pending):
+            if start_vertex != center:
+                if field is None:
+                    field = packed.center_field(center, radius)
+                if not covers(field, radius, start_vertex, max(member[3] for member in pending[start_vertex])):
+                    continue
+
+            for position, lat, long, distance, pref in pending.pop(start_vertex):
+                if tuple(pref) not in graphs:
+                    with metrics.timer("weights"):
+                        graphs[tuple(pref)] = packed.with_preferences(pref)
+                try:
+                    response, search = route_on_graph(graphs[tuple(pref)], start_vertex, distance, progress, read_time_budget(requests[position]))
+                except RouteError as e:
+                    yield position, e
+                    continue
+                if search is None or search["complete"]:
+                    route_cache.put(route_key(start_vertex, distance, pref), response)
+                yield position, format_response(response, requests[position], search)
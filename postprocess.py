@@ -1,124 +1,95 @@
-def get_route_coordinates(G, route):
-    coords = []
-
-    for u, v in zip(route[:-1], route[1:]):
-        data = G.get_edge_data(u, v)
-        # If multiple edges exist, pick the first one
-        edge_data = data[list(data.keys())[0]]  
-        
-        if "geometry" in edge_data:
-            # Use all points in the geometry
-            xs, ys = edge_data["geometry"].xy
-            edge_coords = list(zip(ys, xs))  # (lat, lon)
-        else:
-            # Straight line between nodes
-            x1, y1 = G.nodes[u]['y'], G.nodes[u]['x']
-            x2, y2 = G.nodes[v]['y'], G.nodes[v]['x']
-            edge_coords = [(x1, y1), (x2, y2)]
-        
-        # Why was it risk of duplications?
-        # Avoid duplicating nodes
-        if coords and edge_coords[0] == coords[-1]:
-            del edge_coords[0]
-        coords.extend(edge_coords)
-    
-    return coords
-
-def get_elevation_of_route(G, route):
-    elevation_data = []
-    total_length = 0
-    previous_node = None 
-
-    # Loop all nodes. Keep track of length by remembering last node and total length up til that node.
-    for node in route:
-        if previous_node:
-            total_length += list(G.get_edge_data(previous_node, node).values())[0]["length"]
-
-        elevation_data.append({"length": total_length, "elevation": G.nodes[node]["elevation"]})
-        previous_node = node
-
-    return elevation_data
-
-def get_stats_of_route(route_length, route_gdf):
-
-    total_length = 0
-    
-    length_of_repetition = 0
-    visited_edges = set()
-
-    total_elevation = 0
-
-    length_of_road = 0
-    length_of_trail = 0
-    length_of_nature = 0
-    length_of_lighting = 0
-    
-    number_of_viewpoints = 0
-    number_of_tourism = 0
-
-    for edge, edge_info in route_gdf.iterrows():
-        
-        u, v, _ = edge
-        
-        # Update total length
-        edge_length = edge_info.get("length")
-        total_length += edge_length
-
-        # Update elevation
-        if edge_info.get("rise") and edge_info.get("rise") > 0:
-            total_elevation += edge_info.get("rise")
-
-        # Update surface
-        if edge_info.get("Road") == True:
-            length_of_road += edge_length
-        elif edge_info.get("Trail") == True:
-            length_of_trail += edge_length
-            
-        # Update nature
-        if edge_info.get("Nature") == True:
-            length_of_nature += edge_length
-
-        # Update lighting
-        if edge_info.get("lit") == "yes":
-            length_of_lighting += edge_length
-
-
-        # Update POI
-        if (edge_info.get("Viewpoint") == True) and ((u,v) not in visited_edges) and ((v,u) not in visited_edges):
-            number_of_viewpoints += 1
-            
-        if (edge_info.get("Tourism") == True) and ((u,v) not in visited_edges) and ((v,u) not in visited_edges):
-            number_of_tourism += 1
-            
-        # Update repetition
-        if (u,v) in visited_edges or (v,u) in visited_edges:
-            length_of_repetition += edge_length
-        else:
-            visited_edges.add((u,v))
-
-    
+import numpy as np
+from edge_store import get_edge_store, edge_points
+from routing_core import get_routing_graph, route_edge_ids, first_uses
+
+# Returns the (lat, lon) coordinates along the edges of the route
+def get_route_coordinates(store, edge_ids):
+    # Use all points in the geometry. Edges without geometry are straight lines between their nodes
+    xy, edge_index = edge_points(store, edge_ids)
+
+    # Avoid duplicating nodes, where an edge starts at the last point of the previous edge
+    keep = np.ones(len(xy), dtype=bool)
+    starts = np.flatnonzero(np.diff(edge_index)) + 1
+    keep[starts] = np.any(xy[starts] != xy[starts - 1], axis=1)
+
+    return xy[keep][:, ::-1]
+
+# Builds the coordinates, the elevation profile and the statistics of a route in one pass over its edges
+def summarize_route(G, route, route_length):
+    store = get_edge_store(G)
+    rg = get_routing_graph(G)
+
+    # Resolve the edges of the route once, using the shortest of parallel edges
+    edge_ids = route_edge_ids(rg, route, "length") if len(route) > 1 else np.empty(0, dtype=np.int64)
+    lengths = store.length[edge_ids]
+    total_length = float(lengths.sum())
+
+    # Elevation of each node by the length of the route up to it
+    nodes = np.fromiter((store.node_index[node] for node in route), dtype=np.int64, count=len(route))
+    distances = np.concatenate([[0.0], np.cumsum(lengths)])
+    elevations = store.elevation[nodes]
+    elevation_of_route = [
+        {"length": distance, "elevation": None if np.isnan(elevation) else elevation}
+        for distance, elevation in zip(distances.tolist(), elevations.tolist())
+    ]
+
+    # POIs are only counted the first time an edge is used, later uses count as repetition
+    first_use = first_uses(rg, edge_ids)
+    rise = store.rise[edge_ids]
+    road = store.road[edge_ids]
+    trail = store.trail[edge_ids] & ~road
+
     statistics = dict()
-    
+
     statistics["length"] = total_length
 
     statistics["length_deviation"] = abs(total_length - route_length)
-    
+
     if total_length > 0:
-        statistics["repetition"] = length_of_repetition / total_length
-        statistics["road"] = length_of_road / total_length
-        statistics["trail"] = length_of_trail / total_length
-        statistics["nature"] = length_of_nature / total_length
-        statistics["lighting"] = length_of_lighting / total_length
+        statistics["repetition"] = float(lengths[~first_use].sum()) / total_length
+        statistics["road"] = float(lengths[road].sum()) / total_length
+        statistics["trail"] = float(lengths[trail].sum()) / total_length
+        statistics["nature"] = float(lengths[store.nature[edge_ids]].sum()) / total_length
+        statistics["lighting"] = float(lengths[store.lit[edge_ids]].sum()) / total_length
     else:
         statistics["repetition"] = 0
         statistics["road"] = 0
         statistics["trail"] = 0
         statistics["nature"] = 0
-        statistics["lighting"] = 0       
-        
-    statistics["elevation"] = total_elevation
-
-    statistics["viewpoint"] = number_of_viewpoints
-    statistics["tourism"] = number_of_tourism
-
-    return statistics
\ No newline at end of file
+        statistics["lighting"] = 0
+
+    statistics["elevation"] = float(rise[rise > 0].sum())
+
+    statistics["viewpoint"] = int(np.count_nonzero(store.viewpoint[edge_ids] & first_use))
+    statistics["tourism"] = int(np.count_nonzero(store.tourism[edge_ids] & first_use))
+
+    return {
+        "coordinates": get_route_coordinates(store, edge_ids).tolist(),
+        "elevation_of_route": elevation_of_route,
+        "statistics": statistics,
+    }
+
+# Encodes (lat, lon) coordinates with the encoded polyline algorithm, with precision decimals
+def encode_polyline(coordinates, precision=5):
+    values = np.round(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2) * 10 ** precision).astype(np.int64)
+    if len(values) == 0:
+        return ""
+
+    # Each coordinate is stored as the difference from the previous point, as an unsigned value with the sign in the lowest bit
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    deltas = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    # Split every value into 5 bit chunks, lowest first. All chunks but the last have the continuation bit 0x20 set
+    chunk = np.arange(7)
+    counts = 1 + np.count_nonzero(deltas[:, None] >= (1 << (5 * chunk[1:])), axis=1)
+    chunks = ((deltas[:, None] >> (5 * chunk)) & 0x1f) | np.where(chunk < counts[:, None] - 1, 0x20, 0)
+    return (chunks[chunk < counts[:, None]] + 63).astype(np.uint8).tobytes().decode("ascii")
+
+# Returns a route response in the compact format: the route as an encoded polyline and the elevation profile as columns
+def compact_response(response):
+    profile = response["elevationOfRoute"]
+    return dict(response,
+                route=encode_polyline(response["route"]),
+                elevationOfRoute={"length": [round(point["length"], 1) for point in profile],
+                                  "elevation": [None if point["elevation"] is None else round(point["elevation"], 1) for point in profile]},
+                format="compact")
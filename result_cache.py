@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Number of routes kept in memory, seconds a route is reused, and an optional directory to keep them on disk as well
+ROUTE_CACHE_SIZE = int(os.environ.get("ROUTE_CACHE_SIZE", 256))
+ROUTE_CACHE_TTL = float(os.environ.get("ROUTE_CACHE_TTL", 24 * 3600))
+ROUTE_CACHE_DIR = os.environ.get("ROUTE_CACHE_DIR")
+
+# Route lengths within the same bucket of this many meters share cached routes
+ROUTE_CACHE_DISTANCE_BUCKET = float(os.environ.get("ROUTE_CACHE_DISTANCE_BUCKET", 100))
+
+# Least recently used cache of JSON serializable results, with a time to live and an optional on-disk backing store
+class ResultCache:
+    def __init__(self, max_entries, ttl, directory=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        name = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        entry = self.load(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.store(key, entry)
+            return entry[1]
+
+    def put(self, key, value):
+        entry = (time.time() + self.ttl, value)
+        with self.lock:
+            self.store(key, entry)
+        self.save(key, entry)
+
+    # Adds an entry in memory, evicting the least recently used ones. Must be called with the lock held
+    def store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(key)) as f:
+                expires, value = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if expires < time.time():
+            return None
+        return expires, value
+
+    def save(self, key, entry):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+# Cache of generated routes, shared by all requests
+route_cache = ResultCache(ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL, ROUTE_CACHE_DIR)
+
+# Returns the cache key of a route request
+def route_key(start_vertex, distance, pref):
+    return int(start_vertex), round(distance / ROUTE_CACHE_DISTANCE_BUCKET), tuple(pref)
@@ -1,9 +1,31 @@
-import osmnx as ox
-import networkx as nx
 from networkx.exception import NetworkXNoPath
 from collections import defaultdict
 import random
+import os
 import math
+import time
+import parallel
+import metrics
+import numpy as np
+from routing_core import get_routing_graph, get_distance_field
+from routing_core import evaluate_route
+from landmarks import get_landmark_index, astar_path
+
+# Default number of via-vertex pairs evaluated by the heuristic
+NUMBER_OF_CANDIDATES = int(os.environ.get("ROUTE_CANDIDATES", 10))
+
+# Seconds the greedy fallback may walk before it closes the route
+GREEDY_TIME_BUDGET = float(os.environ.get("GREEDY_TIME_BUDGET", "inf"))
+
+# Default seconds a route request may take, using the anytime search. Unset runs the heuristic with a fixed number of candidates
+ROUTE_TIME_BUDGET = float(os.environ["ROUTE_TIME_BUDGET"]) if os.environ.get("ROUTE_TIME_BUDGET") else None
+
+# Meters of deviation a meter of repeated edges counts as in the anytime search
+REPETITION_PENALTY = float(os.environ.get("ROUTE_REPETITION_PENALTY", 0.5))
+
+# The anytime search stops before its deadline when the deviation is within this share of the route length
+# and no edge is repeated
+ANYTIME_TARGET_DEVIATION = 0.01
 
 # Combines 3 routes into 1 for the heuristic
 def combine_routes(route1, route2, route3):
@@ -25,37 +47,58 @@ def remove_out_and_back(route, via_vertex):
     route[index-i:index+i] = []
     return route
     
+# Returns a boolean mask over the nodes of the routing graph of the isochrone of radius +- 10% around the center node
+def get_isochrone_mask(rg, center_node, radius):
+    field = get_distance_field(rg, center_node, "length", limit=radius*1.1)
+    return field.ring(radius*0.9, radius*1.1)
+
 # Returns isochrone nodes of radius +- 10% around the center node
 def get_isochrone_nodes(graph, center_node, radius):
-    outer_subgraph = nx.ego_graph(graph, center_node, radius=radius*1.1, distance="length")
-    inner_subgraph = nx.ego_graph(graph, center_node, radius=radius*0.9, distance="length")
-
-    return outer_subgraph.nodes - inner_subgraph.nodes
+    rg = get_routing_graph(graph)
+    return set(rg.nodes[get_isochrone_mask(rg, center_node, radius)].tolist())
 
 # Find set of random pairs of via-vertices
-def find_random_pairs_of_via_vertices(G, start_vertex, route_length):
-    isochrone = get_isochrone_nodes(G, start_vertex, route_length/3)
+def find_random_pairs_of_via_vertices(G, start_vertex, route_length, number_of_candidates=10):
+    rg = get_routing_graph(G)
+    isochrone = get_isochrone_mask(rg, start_vertex, route_length/3)
+    isochrone[rg.index(start_vertex)] = False
 
     valid_pairs_of_via_vertices = list()
     
     random.seed(42)
-    random_via_vertices = random.sample(list(isochrone), min(10, len(list(isochrone))))
+    # Sample from the sorted nodes, so the result for a seed does not depend on the order of the nodes
+    isochrone_nodes = np.sort(rg.nodes[isochrone]).tolist()
+    random_via_vertices = random.sample(isochrone_nodes, min(number_of_candidates, len(isochrone_nodes)))
   
     for vv1 in random_via_vertices:
-        isochrone2 = get_isochrone_nodes(G, vv1, route_length/3)
-        for vv2 in isochrone2:
-            if vv2 in isochrone and vv2 != start_vertex:
-                valid_pairs_of_via_vertices.append((vv1, vv2))
-                break
+        # The second via-vertex is the lowest node id in both isochrones
+        both_isochrones = isochrone & get_isochrone_mask(rg, vv1, route_length/3)
+        if both_isochrones.any():
+            valid_pairs_of_via_vertices.append((vv1, int(rg.nodes[both_isochrones].min())))
 
     return valid_pairs_of_via_vertices
 
+# Returns the shortest path between two via-vertices. With a landmark index of the weight an A* search reaches the
+# target without exploring the whole graph, otherwise the path is read from a distance field of the source.
+# Both searches may pick different paths of equal cost, so a request uses one of them for all its legs
+def leg_path(rg, source, target, weight, index=None):
+    if index is not None:
+        return rg.nodes[astar_path(rg, rg.index(source), rg.index(target), weight, index)].tolist()
+    return get_distance_field(rg, source, weight).path(target)
+
+# Returns the landmark index of the heuristic weight if it was built before the request started, or None.
+# A missing index is built in the background for later requests, so the choice does not change during a request
+def ready_landmark_index(G):
+    return get_landmark_index(get_routing_graph(G), "weight_heuristic")
+
 # Generates a route for the heuristic algorithm based on start node and a pair of via-vertices
-def generate_heuristic_route(G, start, viavertex1, viavertex2, pref):
+def generate_heuristic_route(G, start, viavertex1, viavertex2, pref, index=None):
+    # The first and last legs are read from shortest path trees from and to the start, which are shared by all pairs
+    rg = get_routing_graph(G)
     try:
-        route1 = nx.shortest_path(G, source=start, target=viavertex1, weight="weight_heuristic")
-        route2 = nx.shortest_path(G, source=viavertex1, target=viavertex2, weight="weight_heuristic")
-        route3 = nx.shortest_path(G, source=viavertex2, target=start, weight="weight_heuristic")
+        route1 = get_distance_field(rg, start, "weight_heuristic").path(viavertex1)
+        route2 = leg_path(rg, viavertex1, viavertex2, "weight_heuristic", index)
+        route3 = get_distance_field(rg, start, "weight_heuristic", reverse=True).path(viavertex2)
     except NetworkXNoPath:
         return [start]
     
@@ -66,68 +109,261 @@ def generate_heuristic_route(G, start, viavertex1, viavertex2, pref):
     
     return route
 
-def get_length_of_route(route_gdf):
-    return route_gdf["length"].sum()
+# Generates the route of a pair of via-vertices and returns it with its deviation from the route length
+# In worker processes the index is looked up on the attached routing graph, which never builds one
+def evaluate_candidate(G, start_vertex, route_length, pair_of_via_vertices, pref, landmarks=False):
+    index = ready_landmark_index(G) if landmarks else None
+    route = generate_heuristic_route(G, start_vertex, pair_of_via_vertices[0], pair_of_via_vertices[1], pref, index)
+    evaluation = evaluate_route(get_routing_graph(G), route, route_length)
+    return route, evaluation["deviation"]
+
+def heuristic(G, start_vertex, route_length, pref, number_of_candidates=None, workers=None):
+    if number_of_candidates is None:
+        number_of_candidates = NUMBER_OF_CANDIDATES
+    if workers is None:
+        workers = parallel.WORKERS
 
+    with metrics.timer("candidate_generation"):
+        possible_via_vertices = find_random_pairs_of_via_vertices(G, start_vertex, route_length, number_of_candidates)
+    landmarks = ready_landmark_index(G) is not None
+    arguments = [(start_vertex, route_length, pair_of_via_vertices, pref, landmarks) for pair_of_via_vertices in possible_via_vertices]
+    metrics.count("candidates_evaluated", len(arguments))
 
-def heuristic(G, start_vertex, route_length, pref):
-    possible_via_vertices = find_random_pairs_of_via_vertices(G, start_vertex, route_length)
+    with metrics.timer("candidate_evaluation"):
+        if workers > 1 and len(arguments) > 1:
+            # Evaluate the candidates on a process pool, with the routing graph in shared memory
+            weights = [("weight_heuristic", False), ("weight_heuristic", True), ("length", False)]
+            results = parallel.map_on_routing_graph(get_routing_graph(G), evaluate_candidate, arguments, weights, workers)
+        else:
+            results = [evaluate_candidate(G, *args) for args in arguments]
+
+    # The results are in candidate order, so the first route with the lowest deviation wins for a fixed seed
     best_route = [start_vertex]
     best_route_dev = math.inf
-    
-    for i, pair_of_via_vertices in enumerate(possible_via_vertices):
-        route = generate_heuristic_route(G, start_vertex, pair_of_via_vertices[0], pair_of_via_vertices[1], pref)
-        #weight = weight_of_route(ox.routing.route_to_gdf(G, route, weight="weight_heuristic"))
-        if len(route) <= 1:
-            length = 0
-        else:
-            length = get_length_of_route(ox.routing.route_to_gdf(G, route, weight="length"))
-        dev = abs(length - route_length)
+    for route, dev in results:
         if dev < best_route_dev:
             best_route = route
             best_route_dev = dev
     return best_route
     
-def greedy(G, start, k):
-    # Calculate shortest path from every vertex to s using Dijkstra on reverse of graph
-    SPD = nx.single_source_dijkstra_path_length(G.reverse(copy=True), source=start, weight="length")
+def greedy(G, start, k, time_budget=None):
+    if time_budget is None:
+        time_budget = GREEDY_TIME_BUDGET
+    deadline = time.perf_counter() + time_budget
 
-    walk = [start]
+    # Shortest path length from every vertex to s, from the reverse distance field to s which is cached on the routing graph
+    rg = get_routing_graph(G)
+    field = get_distance_field(rg, start, "length", reverse=True)
+    SPD = field.distances.tolist()
+
+    # Adjacency lists of the routing graph, with the length of the shortest edge to each neighbour
+    matrix, _ = rg.get_adjacency("length")
+    indptr = matrix.indptr.tolist()
+    neighbours = matrix.indices.tolist()
+    lengths = matrix.data.tolist()
+
+    s = rg.index(start)
+    walk = [s]
     L = 0
-    u = start
-    Rep = defaultdict(int)  # repetition count of edges (u,v)
+    u = s
+    Rep = defaultdict(int)  # repetition count of edges (u,v), in either direction
+
+    for step in range(2*len(rg.u)):
+        # Stop early when the time budget is used up, the walk is then closed with the shortest path back to start.
+        # The first steps are always taken, so the walk leaves the start even with a very small budget
+        if step % 64 == 63 and time.perf_counter() > deadline:
+            break
 
-    for _ in range(2*G.number_of_edges()):
-        candidates = []
         L_current = L + SPD[u]
 
-        for n in G.neighbors(u):
+        # Pick the candidate with the fewest repetitions, then the longest edge, in a single pass over the neighbours
+        c = None
+        for i in range(indptr[u], indptr[u+1]):
+            n = neighbours[i]
             # Make sure it does not go back to start for as long as possible
-            if start == n:
-                continue
-            
-            if n not in SPD:
+            if n == s or SPD[n] == math.inf:
                 continue
-            L_possible = L + G[u][n][0].get("length") + SPD[n]
+
+            L_possible = L + lengths[i] + SPD[n]
             if abs(k - L_possible) <= abs(k - L_current):
-                candidates.append(n)
+                rep = Rep[(min(u, n), max(u, n))]
+                if c is None or rep < c_rep or (rep == c_rep and lengths[i] > c_length):
+                    c, c_rep, c_length = n, rep, lengths[i]
 
-        if not candidates:
+        if c is None:
             break
 
-        min_rep_nodes = [c for c in candidates if Rep[(u, c)] == min(Rep[(u, c)] for c in candidates)]
-
-        c = max(min_rep_nodes, key=lambda c: G[u][c][0].get("length"))
-        Rep[(u, c)] += 1
-        Rep[(c, u)] += 1
+        Rep[(min(u, c), max(u, c))] += 1
         walk.append(c)
-        L += G[u][c][0].get("length")
+        L += c_length
         u = c
-    
-    if u != start:
-        # append closest walk 
-        shortest_path = nx.shortest_path(G, u, start, weight='length')
-        shortest_path.pop(0)
-        walk.extend(shortest_path)
 
-    return walk
\ No newline at end of file
+    walk = rg.nodes[walk].tolist()
+    if u != s:
+        # append closest walk
+        path_to_start = field.path(walk[-1])
+        path_to_start.pop(0)
+        walk.extend(path_to_start)
+
+    return walk
+
+# Returns the score of a route in the anytime search, lower is better
+def score_route(evaluation):
+    return evaluation["deviation"] + REPETITION_PENALTY * evaluation["repetition"] * evaluation["length"]
+
+# Search for the route from a start vertex that keeps improving until its deadline: it evaluates the via-vertex pairs
+# of the heuristic first, then moves the via-vertices of the best route to neighbouring nodes while that improves it,
+# and samples more pairs when it does not
+class AnytimeSearch:
+    def __init__(self, G, start_vertex, route_length, pref, deadline):
+        self.G = G
+        self.rg = get_routing_graph(G)
+        self.start_vertex = start_vertex
+        self.route_length = route_length
+        self.pref = pref
+        self.deadline = deadline
+        self.index = ready_landmark_index(G)
+
+        self.best_route = [start_vertex]
+        self.best_pair = None
+        self.best_evaluation = None
+        self.best_score = math.inf
+        self.tried = set()
+        self.candidates = 0
+        self.moves = 0
+        self.improvements = 0
+
+        self.random = random.Random(42)
+        self.isochrone = get_isochrone_mask(self.rg, start_vertex, route_length/3)
+        self.isochrone[self.rg.index(start_vertex)] = False
+        self.untried_via_vertices = np.sort(self.rg.nodes[self.isochrone]).tolist()
+
+    def expired(self):
+        return time.perf_counter() > self.deadline
+
+    def good_enough(self):
+        return (self.best_evaluation is not None and self.best_evaluation["repetition"] == 0
+                and self.best_evaluation["deviation"] <= ANYTIME_TARGET_DEVIATION * self.route_length)
+
+    # Evaluates the route of a pair of via-vertices, and keeps it if it is the best so far. Returns True if it is
+    def consider(self, pair):
+        if pair in self.tried or pair[0] == pair[1]:
+            return False
+        self.tried.add(pair)
+
+        route = generate_heuristic_route(self.G, self.start_vertex, pair[0], pair[1], self.pref, self.index)
+        if len(route) == 1:
+            return False
+        evaluation = evaluate_route(self.rg, route, self.route_length)
+        score = score_route(evaluation)
+        if score < self.best_score:
+            self.best_route, self.best_pair, self.best_evaluation, self.best_score = route, pair, evaluation, score
+            return True
+        return False
+
+    # Samples new pairs, where the second via-vertex is a random node in the isochrones of both the start and the first
+    def sample_pairs(self, count):
+        pairs = []
+        while self.untried_via_vertices and len(pairs) < count:
+            vv1 = self.untried_via_vertices.pop(self.random.randrange(len(self.untried_via_vertices)))
+            both_isochrones = self.isochrone & get_isochrone_mask(self.rg, vv1, self.route_length/3)
+            if both_isochrones.any():
+                pairs.append((vv1, self.random.choice(np.sort(self.rg.nodes[both_isochrones]).tolist())))
+        return pairs
+
+    # Returns the neighbours of a node, ordered to move the route in the direction that reduces its length deviation
+    def neighbours(self, node):
+        matrix, _ = self.rg.get_adjacency("length")
+        i = self.rg.index(node)
+        neighbours = matrix.indices[matrix.indptr[i]:matrix.indptr[i+1]]
+        distances = get_distance_field(self.rg, self.start_vertex, "length", limit=self.route_length/3*1.1).distances[neighbours]
+        too_short = self.best_evaluation["length"] < self.route_length
+        order = np.argsort(-distances if too_short else distances, kind="stable")
+        return [node for node in self.rg.nodes[neighbours[order]].tolist() if node != self.start_vertex]
+
+    # Moves one via-vertex of the best route at a time to a neighbouring node, as long as that improves the route.
+    # Moves of the second via-vertex are tried first, as they only need shortest path trees that are already computed
+    def local_search(self):
+        improved_any = False
+        improved = self.best_pair is not None
+        while improved and not self.expired() and not self.good_enough():
+            improved = False
+            vv1, vv2 = self.best_pair
+            moves = [(vv1, node) for node in self.neighbours(vv2)] + [(node, vv2) for node in self.neighbours(vv1)]
+            for pair in moves:
+                if self.expired():
+                    break
+                if pair in self.tried:
+                    continue
+                self.moves += 1
+                if self.consider(pair):
+                    self.improvements += 1
+                    improved = improved_any = True
+                    break
+        return improved_any
+
+    def run(self, number_of_candidates):
+        # The pairs of the heuristic first, so with enough time every route the heuristic would consider is considered
+        # The first pair is always evaluated, so there is a route to return even with a very small budget
+        complete = True
+        for pair in find_random_pairs_of_via_vertices(self.G, self.start_vertex, self.route_length, number_of_candidates):
+            if self.expired() and self.candidates > 0:
+                complete = False
+                break
+            self.candidates += 1
+            self.consider(pair)
+
+        while not self.expired() and not self.good_enough():
+            improved = self.local_search()
+            if self.expired() or self.good_enough():
+                break
+
+            pairs = self.sample_pairs(number_of_candidates)
+            if not pairs and not improved:
+                break
+            for pair in pairs:
+                if self.expired():
+                    break
+                self.candidates += 1
+                self.consider(pair)
+
+        return complete
+
+# Searches for a route until the time budget in seconds is used up or the route is good enough. The budget runs from
+# start_time, e.g. the start of the request, or else from the start of the search. Returns the route and a report of
+# the search: the budget, the time used since start_time and its share of the budget, the time the search itself had
+# and used, the candidates and local moves evaluated, and the deviation and repetition reached. complete is False if
+# the budget ran out before the candidates of the heuristic were evaluated
+def anytime(G, start_vertex, route_length, pref, time_budget, number_of_candidates=None, start_time=None):
+    if number_of_candidates is None:
+        number_of_candidates = NUMBER_OF_CANDIDATES
+    search_start = time.perf_counter()
+    if start_time is None:
+        start_time = search_start
+
+    search = AnytimeSearch(G, start_vertex, route_length, pref, start_time + time_budget)
+    complete = search.run(number_of_candidates)
+    route = search.best_route
+
+    # Fall back to the greedy walk with the time that is left
+    fallback = len(route) == 1
+    if fallback:
+        route = greedy(G, start_vertex, route_length, time_budget=max(0, search.deadline - time.perf_counter()))
+
+    evaluation = evaluate_route(search.rg, route, route_length)
+    end_time = time.perf_counter()
+    used = end_time - start_time
+    return route, {
+        "budget": time_budget,
+        "used": used,
+        "budgetUsed": used / time_budget if time_budget > 0 else 1,
+        "searchBudget": max(0, search.deadline - search_start),
+        "searchUsed": end_time - search_start,
+        "candidates": search.candidates,
+        "moves": search.moves,
+        "improvements": search.improvements,
+        "fallback": fallback,
+        "complete": complete,
+        "deviation": evaluation["deviation"],
+        "repetition": evaluation["repetition"],
+    }
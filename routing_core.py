@@ -0,0 +1,219 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from networkx.exception import NetworkXNoPath
+from edge_store import get_edge_store
+import metrics
+
+# Value scipy uses in the predecessor arrays for nodes without a predecessor
+NO_PREDECESSOR = -9999
+
+# Number of distance fields kept per routing graph
+DISTANCE_FIELD_CACHE_SIZE = 64
+
+# Array representation of a graph for shortest path searches. Nodes are numbered 0..n-1 in the order of the edge store,
+# and there is one CSR adjacency matrix per weight type
+class RoutingGraph:
+    # The node index maps node ids to their positions in nodes. It is built if not given, e.g. from an edge store
+    def __init__(self, nodes, weights, u, v, node_index=None):
+        self.nodes = nodes
+        self.node_index = node_index if node_index is not None else {node: i for i, node in enumerate(nodes.tolist())}
+        self.weights = weights
+        self.u = u
+        self.v = v
+
+        # (matrix, edge ids) per weight type and direction, built when first used
+        self.adjacency = dict()
+
+        # Least recently used distance fields by (source, weight, reverse)
+        self.distance_fields = OrderedDict()
+
+        # Sorted row * n + column keys of the stored values of each adjacency matrix, for looking up edges
+        self.adjacency_keys = dict()
+
+        # Landmark indexes by fingerprint of the edges and weights, shared by the routing graphs of a packed graph.
+        # The directory they are stored in is set for graphs opened from disk
+        self.landmarks = dict()
+        self.landmark_keys = dict()
+        self.landmarks_building = set()
+        self.landmarks_lock = threading.Lock()
+        self.directory = None
+
+    @property
+    def number_of_nodes(self):
+        return len(self.nodes)
+
+    def index(self, node):
+        return self.node_index[node]
+
+    # Returns the CSR matrix and, for each stored value, the id of the edge it comes from
+    def get_adjacency(self, weight, reverse=False):
+        key = (weight, reverse)
+        if key not in self.adjacency:
+            if reverse:
+                self.adjacency[key] = build_adjacency(self.v, self.u, self.weights[weight], self.number_of_nodes)
+            else:
+                self.adjacency[key] = build_adjacency(self.u, self.v, self.weights[weight], self.number_of_nodes)
+        return self.adjacency[key]
+
+    # Returns the sorted keys row * n + column of the stored values of an adjacency matrix
+    def get_adjacency_keys(self, weight, reverse=False):
+        key = (weight, reverse)
+        if key not in self.adjacency_keys:
+            matrix, _ = self.get_adjacency(weight, reverse)
+            rows = np.repeat(np.arange(self.number_of_nodes, dtype=np.int64), np.diff(matrix.indptr))
+            self.adjacency_keys[key] = rows * self.number_of_nodes + matrix.indices
+        return self.adjacency_keys[key]
+
+# Builds a CSR matrix from edge arrays. Of parallel edges only the one with the lowest weight is kept, as networkx does
+def build_adjacency(u, v, w, number_of_nodes):
+    order = np.lexsort((w, v, u))
+    u_sorted = u[order]
+    v_sorted = v[order]
+
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (u_sorted[1:] != u_sorted[:-1]) | (v_sorted[1:] != v_sorted[:-1])
+    edge_ids = order[first]
+
+    indptr = np.zeros(number_of_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(u[edge_ids], minlength=number_of_nodes), out=indptr[1:])
+    matrix = csr_matrix((w[edge_ids], v[edge_ids], indptr), shape=(number_of_nodes, number_of_nodes))
+    return matrix, edge_ids
+
+# Builds a routing graph from an edge store and a dict with a weight array per weight type
+def build_routing_graph(store, weights):
+    # The edge store and its views share the node index, so the routing graph of each request does not build its own
+    return RoutingGraph(store.nodes, weights, store.u, store.v, store.node_index)
+
+# Returns the routing graph of G with the length and all the weights assigned to the graph.
+# It is kept in the graph attributes, so it is only built once per graph
+def get_routing_graph(G):
+    if isinstance(G, RoutingGraph):
+        return G
+
+    if "routing_graph" not in G.graph:
+        store = get_edge_store(G)
+        weights = {name: values for name, values in store.cache.items() if name.startswith("weight_")}
+        weights["length"] = store.length
+        G.graph["routing_graph"] = build_routing_graph(store, weights)
+
+    return G.graph["routing_graph"]
+
+# Runs Dijkstra from the source index and returns the distance and predecessor of every node.
+# Nodes further away than limit get distance inf. With reverse=True the distances are to the source instead of from it
+def single_source(rg, source, weight, limit=np.inf, reverse=False):
+    matrix, _ = rg.get_adjacency(weight, reverse)
+    metrics.count("shortest_path_searches")
+    with metrics.timer("shortest_path"):
+        return dijkstra(matrix, directed=True, indices=source, return_predecessors=True, limit=limit)
+
+# Follows the predecessors from the target back to the source and returns the path as node indices
+def path_from_predecessors(predecessors, source, target):
+    path = [target]
+    while path[-1] != source:
+        previous = predecessors[path[-1]]
+        if previous == NO_PREDECESSOR:
+            raise NetworkXNoPath(f"No path between {source} and {target}")
+        path.append(previous)
+    path.reverse()
+    return path
+
+# Returns the shortest path from source to target as a list of node ids
+def shortest_path(rg, source, target, weight):
+    source_index = rg.index(source)
+    _, predecessors = single_source(rg, source_index, weight)
+    return rg.nodes[path_from_predecessors(predecessors, source_index, rg.index(target))].tolist()
+
+# Returns the distance from the source node to all nodes within limit, as a dict from node id to distance
+def distances_from(rg, source, weight, limit=np.inf, reverse=False):
+    distances, _ = single_source(rg, rg.index(source), weight, limit, reverse)
+    reached = np.flatnonzero(np.isfinite(distances))
+    return dict(zip(rg.nodes[reached].tolist(), distances[reached].tolist()))
+
+# Returns the positions in the adjacency matrix of the weight of the edges between consecutive nodes of a route.
+# Between nodes with parallel edges the edge with the lowest weight is used
+def route_slots(rg, route, weight="length"):
+    indices = np.fromiter((rg.index(node) for node in route), dtype=np.int64, count=len(route))
+    keys = rg.get_adjacency_keys(weight)
+    route_keys = indices[:-1] * rg.number_of_nodes + indices[1:]
+    slots = np.searchsorted(keys, route_keys)
+    if np.any(slots >= len(keys)) or np.any(keys[np.minimum(slots, len(keys) - 1)] != route_keys):
+        raise NetworkXNoPath("The route contains nodes that are not connected by an edge")
+    return slots
+
+# Returns the ids of the edges of a route in the edge store, using the edge with the lowest weight between parallel edges
+def route_edge_ids(rg, route, weight="length"):
+    _, edge_ids = rg.get_adjacency(weight)
+    return edge_ids[route_slots(rg, route, weight)]
+
+# Returns a boolean mask of the edges of a route that are used for the first time. Edges are identified by their
+# node pair regardless of direction, so every use after the first in either direction is a repetition
+def first_uses(rg, edge_ids):
+    u, v = rg.u[edge_ids], rg.v[edge_ids]
+    pair_keys = np.minimum(u, v) * rg.number_of_nodes + np.maximum(u, v)
+    _, first_use = np.unique(pair_keys, return_index=True)
+    mask = np.zeros(len(pair_keys), dtype=bool)
+    mask[first_use] = True
+    return mask
+
+# Evaluates a route straight from the edge arrays. Returns its length, its cost in the weight, the share of the length
+# on edges already used earlier in the route (in either direction) and the deviation from the wanted route length
+def evaluate_route(rg, route, route_length=None, weight="weight_heuristic"):
+    evaluation = {"length": 0.0, "cost": 0.0, "repetition": 0.0}
+    if len(route) > 1:
+        edge_ids = route_edge_ids(rg, route, "length")
+        lengths = rg.weights["length"][edge_ids]
+        evaluation["length"] = float(lengths.sum())
+
+        if weight in rg.weights:
+            matrix, _ = rg.get_adjacency(weight)
+            evaluation["cost"] = float(matrix.data[route_slots(rg, route, weight)].sum())
+
+        repeated = ~first_uses(rg, edge_ids)
+        if evaluation["length"] > 0:
+            evaluation["repetition"] = float(lengths[repeated].sum()) / evaluation["length"]
+
+    if route_length is not None:
+        evaluation["deviation"] = abs(evaluation["length"] - route_length)
+
+    return evaluation
+
+# Shortest path tree from a source node to all nodes within limit, or to the source from all nodes if reverse is True
+class DistanceField:
+    def __init__(self, rg, source, weight, reverse, limit):
+        self.rg = rg
+        self.source = source
+        self.weight = weight
+        self.reverse = reverse
+        self.limit = limit
+        self.distances, self.predecessors = single_source(rg, source, weight, limit, reverse)
+
+    def distance(self, node):
+        return self.distances[self.rg.index(node)]
+
+    # Returns the shortest path between the source and the node as a list of node ids, in the direction of the edges
+    def path(self, node):
+        path = path_from_predecessors(self.predecessors, self.source, self.rg.index(node))
+        if self.reverse:
+            path.reverse()
+        return self.rg.nodes[path].tolist()
+
+    # Returns a boolean mask of the nodes with distance in the interval (low, high]
+    def ring(self, low, high):
+        return (self.distances > low) & (self.distances <= high)
+
+# Returns the distance field of a source node. Fields are cached on the routing graph, and a field computed
+# with a larger limit is reused for smaller ones
+def get_distance_field(rg, source, weight, reverse=False, limit=np.inf):
+    key = (source, weight, reverse)
+    field = rg.distance_fields.get(key)
+    if field is None or field.limit < limit:
+        field = DistanceField(rg, rg.index(source), weight, reverse, limit)
+        rg.distance_fields[key] = field
+        if len(rg.distance_fields) > DISTANCE_FIELD_CACHE_SIZE:
+            rg.distance_fields.popitem(last=False)
+    else:
+        rg.distance_fields.move_to_end(key)
+    return field
@@ -0,0 +1,136 @@
+import os
+import math
+import pickle
+import threading
+import numpy as np
+import osmnx as ox
+import networkx as nx
+from collections import OrderedDict
+from scipy.spatial import cKDTree
+import tile_cache
+
+# Points further than this many meters from the nearest node are not snapped to the network
+SNAP_MAX_DISTANCE = float(os.environ.get("SNAP_MAX_DISTANCE", 1000))
+
+# Nodes in connected parts of a tile with fewer nodes than this are left out of its index, so points are not
+# snapped to small pieces of network that are cut off from the rest
+MIN_COMPONENT_SIZE = 20
+
+# Number of tile indexes kept in memory
+INDEX_CACHE_SIZE = 64
+
+# Node id used in the results of snap_points for points that are not snapped
+NO_NODE = -1
+
+EARTH_RADIUS_M = 6371009
+
+# Projects lat, long to 3D coordinates in meters on a sphere. The straight line distance between two projected points
+# is within a millimeter of the great circle distance for the distances snapping is used for
+def project_points(lats, longs):
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    longs = np.radians(np.asarray(longs, dtype=np.float64))
+    return EARTH_RADIUS_M * np.stack([np.cos(lats) * np.cos(longs), np.cos(lats) * np.sin(longs), np.sin(lats)], axis=-1)
+
+# KD-tree over the projected coordinates of a set of nodes
+class SnapIndex:
+    def __init__(self, nodes, lats, longs):
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.tree = cKDTree(project_points(lats, longs))
+
+    # Returns the nearest node and the distance to it for each point, NO_NODE and inf for points further than max_distance
+    def query(self, lats, longs, max_distance=None):
+        if max_distance is None:
+            max_distance = SNAP_MAX_DISTANCE
+        if len(self.nodes) == 0:
+            return np.full(len(lats), NO_NODE, dtype=np.int64), np.full(len(lats), np.inf)
+
+        distances, positions = self.tree.query(project_points(lats, longs), distance_upper_bound=max_distance)
+        found = np.isfinite(distances)
+        nodes = np.full(len(distances), NO_NODE, dtype=np.int64)
+        nodes[found] = self.nodes[positions[found]]
+        return nodes, distances
+
+# Builds a snap index over the nodes of a graph that are kept when it is simplified, leaving out connected parts with
+# fewer than min_component_size nodes. With a tile only the nodes in the tile are indexed, as the nodes of a tile graph
+# just outside the tile may be removed when the stitched graph is simplified. Small parts that cross the tile border
+# are kept, as they may be pieces of a larger part cut by the border
+def build_snap_index(G, tile=None, min_component_size=MIN_COMPONENT_SIZE):
+    large = set()
+    for component in nx.weakly_connected_components(G):
+        if len(component) >= min_component_size or (tile is not None and any(tile_cache.tile_of(G.nodes[node]["y"], G.nodes[node]["x"]) != tile for node in component)):
+            large.update(component)
+    if not G.graph.get("simplified") and G.number_of_edges() != 0:
+        G = ox.simplify_graph(G)
+
+    nodes = [node for node, data in G.nodes(data=True) if node in large and (tile is None or tile_cache.tile_of(data["y"], data["x"]) == tile)]
+    nodes.sort()
+    return SnapIndex(nodes, [G.nodes[node]["y"] for node in nodes], [G.nodes[node]["x"] for node in nodes])
+
+# Tile indexes loaded by this process, by tile
+loaded_indexes = OrderedDict()
+loaded_indexes_lock = threading.Lock()
+
+def index_path(tile):
+    return tile_cache.companion_path(tile, ".snap")
+
+# Returns the snap index of a tile. Indexes are stored next to the tiles and built from the tile graph when missing
+def get_tile_index(tile):
+    path = index_path(tile)
+    with loaded_indexes_lock:
+        loaded = loaded_indexes.get(tile)
+        if loaded is not None and os.path.exists(path) and loaded[0] == os.path.getmtime(path):
+            loaded_indexes.move_to_end(tile)
+            return loaded[1]
+
+    try:
+        with open(path, "rb") as f:
+            index = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        index = build_snap_index(tile_cache.get_tile(tile), tile)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    with loaded_indexes_lock:
+        loaded_indexes[tile] = (os.path.getmtime(path), index)
+        loaded_indexes.move_to_end(tile)
+        while len(loaded_indexes) > INDEX_CACHE_SIZE:
+            loaded_indexes.popitem(last=False)
+    return index
+
+# Snaps many points at once to the nearest node of the cached tiles within max_distance.
+# Returns the node ids, NO_NODE for points that are not snapped, and the distances in meters
+def snap_points(lats, longs, max_distance=None):
+    if max_distance is None:
+        max_distance = SNAP_MAX_DISTANCE
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    nodes = np.full(len(lats), NO_NODE, dtype=np.int64)
+    distances = np.full(len(lats), np.inf)
+
+    # Group the points by the tile they are in, and search the tiles within max_distance of each group
+    point_tiles = np.floor(np.stack([lats, longs], axis=1) / tile_cache.TILE_SIZE).astype(np.int64)
+    groups = dict()
+    for i, tile in enumerate(map(tuple, point_tiles.tolist())):
+        groups.setdefault(tile, []).append(i)
+
+    for (row, col), members in groups.items():
+        members = np.array(members)
+        delta_lat = math.degrees(max_distance / EARTH_RADIUS_M)
+        delta_long = delta_lat / max(math.cos(math.radians(lats[members].max(initial=0))), math.cos(math.radians(lats[members].min(initial=0))), 1e-6)
+        west, south, east, north = tile_cache.tile_bbox((row, col))
+        for tile in tile_cache.tiles_for_bbox((west - delta_long, south - delta_lat, east + delta_long, north + delta_lat)):
+            tile_nodes, tile_distances = get_tile_index(tile).query(lats[members], longs[members], max_distance)
+            closer = tile_distances < distances[members]
+            nodes[members[closer]] = tile_nodes[closer]
+            distances[members[closer]] = tile_distances[closer]
+
+    return nodes, distances
+
+# Snaps a single point to the network, raises ValueError if there is no node within max_distance
+def snap_point(lat, long, max_distance=None):
+    nodes, _ = snap_points([lat], [long], max_distance)
+    if nodes[0] == NO_NODE:
+        raise ValueError("No paths near the point")
+    return int(nodes[0])
@@ -0,0 +1,343 @@
+import os
+import time
+import math
+import json
+import pickle
+import threading
+from contextlib import contextmanager
+import osmnx as ox
+import networkx as nx
+from osmnx._errors import InsufficientResponseError
+from collections import defaultdict
+
+# Side length of a tile in degrees (0.02 degrees is roughly 2.2 km north-south)
+TILE_SIZE = float(os.environ.get("TILE_SIZE", 0.02))
+
+# Where the tiles are stored, how much disk they may use and how old a tile may get before it is downloaded again
+CACHE_DIR = os.environ.get("TILE_CACHE_DIR", os.path.join("cache", "tiles"))
+MAX_CACHE_BYTES = int(os.environ.get("TILE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+MAX_TILE_AGE = float(os.environ.get("TILE_CACHE_MAX_AGE", 30 * 24 * 3600))
+
+# With OFFLINE set nothing is downloaded: cached tiles (e.g. from osm_extract.py) never expire, and tiles missing
+# from the cache have no paths
+OFFLINE = os.environ.get("OFFLINE", "").lower() in ("1", "true", "yes")
+
+# OSM tags kept on the nodes and edges of downloaded and ingested graphs, instead of the many default tags of OSMnx
+# that are never used. The surface and lighting of the ways are not among the default tags
+USEFUL_TAGS_NODE = []
+USEFUL_TAGS_WAY = ["highway", "surface", "lit", "oneway", "junction"]
+
+# Number of graphs being downloaded or parsed with the tags, and the OSMnx settings to restore when they are done
+network_tags_users = 0
+network_tags_saved = None
+network_tags_lock = threading.Lock()
+
+# Makes OSMnx keep only the useful tags while a tile graph is downloaded or parsed in the block, and restores the
+# settings of the other users of OSMnx when the last block running at the same time ends
+@contextmanager
+def network_tags():
+    global network_tags_users, network_tags_saved
+    with network_tags_lock:
+        if network_tags_users == 0:
+            network_tags_saved = (ox.settings.useful_tags_node, ox.settings.useful_tags_way)
+            ox.settings.useful_tags_node = USEFUL_TAGS_NODE
+            ox.settings.useful_tags_way = USEFUL_TAGS_WAY
+        network_tags_users += 1
+    try:
+        yield
+    finally:
+        with network_tags_lock:
+            network_tags_users -= 1
+            if network_tags_users == 0:
+                ox.settings.useful_tags_node, ox.settings.useful_tags_way = network_tags_saved
+
+# Node and edge attributes kept by compact_graph, the ones the enrichment and routing read
+COMPACT_NODE_ATTRIBUTES = {"x", "y", "elevation"}
+COMPACT_EDGE_ATTRIBUTES = {"length", "geometry", "highway", "surface", "lit"}
+
+# Returns the tile (row, column) containing a lat, long point
+def tile_of(lat, long):
+    return math.floor(lat / TILE_SIZE), math.floor(long / TILE_SIZE)
+
+# Returns the bounding box (west, south, east, north) of a tile
+def tile_bbox(tile):
+    row, col = tile
+    return col * TILE_SIZE, row * TILE_SIZE, (col + 1) * TILE_SIZE, (row + 1) * TILE_SIZE
+
+# Returns all tiles overlapping a bounding box (west, south, east, north)
+def tiles_for_bbox(bbox):
+    west, south, east, north = bbox
+    min_row, min_col = tile_of(south, west)
+    max_row, max_col = tile_of(north, east)
+    return [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+
+def tile_path(tile):
+    return os.path.join(CACHE_DIR, f"{tile[0]}_{tile[1]}.pkl")
+
+# Path of a file derived from a tile (e.g. its snapping index), which is removed when the tile is downloaded again
+def companion_path(tile, suffix):
+    return os.path.join(CACHE_DIR, f"{tile[0]}_{tile[1]}{suffix}.pkl")
+
+def is_stale(path):
+    return not OFFLINE and time.time() - os.path.getmtime(path) > MAX_TILE_AGE
+
+# Loads a tile from disk. Returns None if the tile is missing or stale. Tiles cached simplified by earlier versions
+# count as missing, as their graphs can not be stitched and simplified again without losing edge geometry
+def load_tile(tile):
+    path = tile_path(tile)
+    try:
+        # The modification time is used for expiry, so it is only reset on download
+        if is_stale(path):
+            return None
+        with open(path, "rb") as f:
+            G = pickle.load(f)
+        if G.graph.get("simplified"):
+            return None
+        # The access time is used for the least recently used eviction
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+        return G
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+# Writes a tile to disk. The file is written to a temporary path first, so readers never see a partial tile
+def save_tile(tile, G):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = tile_path(tile)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(G, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+# Returns whether a tile is in the cache and not stale, without loading it
+def is_cached(tile):
+    try:
+        return not is_stale(tile_path(tile))
+    except FileNotFoundError:
+        return False
+
+# Locks by tile, held while a missing tile is downloaded so concurrent misses of the same tile download it once
+tile_locks = defaultdict(threading.Lock)
+tile_locks_lock = threading.Lock()
+
+def tile_lock(tile):
+    with tile_locks_lock:
+        return tile_locks[tile]
+
+# Downloads the unsimplified graph of a bounding box (west, south, east, north). Tiles are only simplified after they
+# are stitched together, so ways crossing a tile border keep their nodes on both sides of it
+def download_bbox(bbox):
+    try:
+        # Keep edges crossing the border so neighbouring tiles connect when stitched together
+        with network_tags():
+            G = ox.graph.graph_from_bbox(bbox, network_type="all", simplify=False, retain_all=True, truncate_by_edge=True)
+    except (InsufficientResponseError, ValueError):
+        # Store empty tiles as well, so areas without paths are not downloaded again
+        return nx.MultiDiGraph(crs="epsg:4326")
+
+    # Edges of an unsimplified graph are straight lines without geometry attribute
+    return G
+
+def download_tile(tile):
+    return download_bbox(tile_bbox(tile))
+
+# Downloads the tiles that are not cached with one query for their combined bounding box, and splits the graph into
+# the tiles. The optional check function is called with the downloaded graph before it is split
+def download_tiles(tiles, check=None):
+    # The locks are taken in order, so requests missing overlapping tiles do not wait on each other in a cycle
+    locks = [tile_lock(tile) for tile in sorted(set(tiles))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        missing = [tile for tile in tiles if not is_cached(tile)]
+        if not missing:
+            return
+        bboxes = [tile_bbox(tile) for tile in missing]
+        G = download_bbox((min(bbox[0] for bbox in bboxes), min(bbox[1] for bbox in bboxes),
+                           max(bbox[2] for bbox in bboxes), max(bbox[3] for bbox in bboxes)))
+        if check is not None:
+            check(G)
+        for tile, tile_graph in split_graph(G, missing).items():
+            save_tile(tile, tile_graph)
+            remove_companions(tile)
+    finally:
+        for lock in locks:
+            lock.release()
+
+# Splits a graph into the graphs of the tiles, keeping the edges crossing a tile border in both tiles like download_tile
+def split_graph(G, tiles):
+    tile_nodes = {tile: set() for tile in tiles}
+    for node, data in G.nodes(data=True):
+        tile = tile_of(data["y"], data["x"])
+        if tile in tile_nodes:
+            tile_nodes[tile].add(node)
+
+    graphs = dict()
+    for tile, inside in tile_nodes.items():
+        nodes = set(inside)
+        for node in inside:
+            nodes.update(G.successors(node))
+            nodes.update(G.predecessors(node))
+        graphs[tile] = nx.MultiDiGraph(G.subgraph(nodes))
+        graphs[tile].graph.update({"crs": "epsg:4326", "simplified": False})
+    return graphs
+
+# Returns the graph of a tile, downloading it if it is not in the cache. With enforce_budget=False the caller keeps the
+# cache within its size budget, e.g. once after getting all the tiles of a graph
+def get_tile(tile, enforce_budget=True):
+    G = load_tile(tile)
+    if G is None and OFFLINE:
+        return nx.MultiDiGraph(crs="epsg:4326")
+    if G is None:
+        with tile_lock(tile):
+            # Another thread may have downloaded the tile meanwhile
+            G = load_tile(tile)
+            if G is None:
+                G = download_tile(tile)
+                save_tile(tile, G)
+                remove_companions(tile)
+        if enforce_budget:
+            enforce_size_budget()
+    return G
+
+def remove_companions(tile):
+    prefix = f"{tile[0]}_{tile[1]}."
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith(prefix) and name.endswith(".pkl") and name != prefix + "pkl":
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except FileNotFoundError:
+                pass
+
+# Returns the file names of the tiles built from local extracts by osm_extract.py, from its manifest
+def ingested_tiles():
+    try:
+        with open(os.path.join(CACHE_DIR, "extracts.json")) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return set()
+    return {f"{name}.pkl" for extract in manifest.values() for name in extract.get("tiles", {})}
+
+# Deletes the least recently used tiles until the cache fits within the size budget. Tiles built from local extracts
+# are kept, as they may not be downloadable again (e.g. with OFFLINE set), but count towards the budget
+def enforce_size_budget(max_bytes=None):
+    if max_bytes is None:
+        max_bytes = MAX_CACHE_BYTES
+    if not os.path.isdir(CACHE_DIR):
+        return
+
+    ingested = ingested_tiles()
+    tiles = []
+    total_size = 0
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".pkl"):
+            stat = os.stat(os.path.join(CACHE_DIR, name))
+            total_size += stat.st_size
+            if name not in ingested:
+                tiles.append((stat.st_atime, stat.st_size, name))
+
+    for _, size, name in sorted(tiles):
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+# Removes cached tiles. Only tiles overlapping bbox are removed if given, and only tiles older than max_age seconds if given
+def invalidate_tiles(bbox=None, max_age=None):
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+
+    # Files derived from a tile start with the same row and column, and are removed with it
+    selected = None if bbox is None else {f"{row}_{col}" for row, col in tiles_for_bbox(bbox)}
+    removed = 0
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith(".pkl") or (selected is not None and name.split(".")[0] not in selected):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        if max_age is not None and time.time() - os.path.getmtime(path) <= max_age:
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+
+    return removed
+
+# Combines the graphs of several tiles into one graph. The graphs may be a generator, so each tile can be freed
+# once it is added. The optional check function is called with the graph after each tile, and may raise to stop
+# before the other tiles are loaded
+def stitch_tiles(graphs, check=None):
+    G = nx.MultiDiGraph()
+    for tile_graph in graphs:
+        G.add_nodes_from(tile_graph.nodes(data=True))
+        G.add_edges_from(tile_graph.edges(keys=True, data=True))
+        if check is not None:
+            check(G)
+    G.graph.update({"crs": "epsg:4326", "simplified": False})
+    return G
+
+# Removes the node and edge attributes that are not used (e.g. tags of tiles cached with other tags and the
+# osmid of the edges), and shares equal string values, to reduce the memory used by large graphs
+def compact_graph(G):
+    strings = dict()
+    for _, data in G.nodes(data=True):
+        for attribute in [attribute for attribute in data if attribute not in COMPACT_NODE_ATTRIBUTES]:
+            del data[attribute]
+    for _, _, data in G.edges(data=True):
+        for attribute in [attribute for attribute in data if attribute not in COMPACT_EDGE_ATTRIBUTES]:
+            del data[attribute]
+        for attribute in ("highway", "surface", "lit"):
+            value = data.get(attribute)
+            if isinstance(value, str):
+                data[attribute] = strings.setdefault(value, value)
+    return G
+
+# Returns the simplified graph within a network distance of dist around the start point, using cached tiles where possible
+# The start node can be given when the start point is already snapped to the network.
+# With compact=True the unused attributes are removed from each tile before the tiles are stitched together.
+# The tiles missing from the cache are downloaded with one query. Check is passed on to download_tiles and stitch_tiles
+def load_graph(start_point, dist, start_node=None, compact=False, check=None):
+    bbox = ox.utils_geo.bbox_from_point(start_point, dist)
+    tiles = tiles_for_bbox(bbox)
+    if not OFFLINE:
+        download_tiles([tile for tile in tiles if not is_cached(tile)], check)
+    G = stitch_tiles((compact_graph(get_tile(tile, False)) if compact else get_tile(tile, False) for tile in tiles), check)
+    enforce_size_budget()
+    if G.number_of_nodes() == 0:
+        raise ValueError("No graph nodes in the tiles around the start point")
+
+    # Cut the stitched graph down to the requested network distance, as graph_from_point does with dist_type="network",
+    # and simplify it once, so ways crossing tile borders become single edges
+    if start_node is None or start_node not in G.nodes:
+        lat, long = start_point
+        start_node = ox.nearest_nodes(G, long, lat)
+    G = ox.truncate.truncate_graph_dist(G, start_node, dist)
+    return ox.simplify_graph(G)
+
+# Stores a node attribute computed for nodes at the given coordinates in the tiles the nodes belong to, so it is not
+# computed again. Nodes that already have the attribute in their tile are left as they are
+def store_node_values(nodes, lats, longs, name, values):
+    by_tile = defaultdict(dict)
+    for node, lat, long, value in zip(nodes, lats, longs, values):
+        by_tile[tile_of(lat, long)][node] = value
+
+    for tile, tile_values in by_tile.items():
+        tile_graph = load_tile(tile)
+        if tile_graph is None:
+            continue
+
+        changed = False
+        for node, data in tile_graph.nodes(data=True):
+            if name not in data and node in tile_values:
+                data[name] = tile_values[node]
+                changed = True
+
+        if changed:
+            # Keep the original download time, so enriching a tile does not extend its lifetime
+            path = tile_path(tile)
+            mtime = os.path.getmtime(path)
+            save_tile(tile, tile_graph)
+            os.utime(path, (time.time(), mtime))
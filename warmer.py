@@ -0,0 +1,180 @@
+import os
+import json
+import fcntl
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import packed_graph
+from hotspots import hotspots, WARM_SPOT_RADIUS
+from snapping import snap_point
+from routing_core import get_routing_graph
+from landmarks import get_landmark_index
+from pipeline import get_prepared_graph, find_warm_graph, packed_graph_key, read_preferences, layers_for
+
+# Set to 0 to not warm graphs in the background
+WARMER_ENABLED = os.environ.get("WARMER_ENABLED", "1") != "0"
+
+# Seconds between the checks for spots to warm, and the number of graphs prepared at the same time
+WARMER_INTERVAL = float(os.environ.get("WARMER_INTERVAL", 60))
+WARMER_WORKERS = int(os.environ.get("WARMER_WORKERS", 1))
+
+# Requests from a start vertex before it is warmed, unless it is in the configured list
+WARMER_MIN_REQUESTS = int(os.environ.get("WARMER_MIN_REQUESTS", 3))
+
+# Seconds after which a warm graph is prepared again, before the packed graph gets too old to be used
+WARMER_REFRESH_AGE = float(os.environ.get("WARMER_REFRESH_AGE", packed_graph.PACKED_GRAPH_MAX_AGE * 0.8))
+
+# Seconds before a spot that failed to warm is tried again
+WARMER_RETRY_DELAY = float(os.environ.get("WARMER_RETRY_DELAY", 3600))
+
+# JSON file with a list of spots to keep warm: {"coords": [lat, long], "distance": meters} and optionally
+# "preferences", a list of objects with the preference fields of a route request
+WARM_SPOTS_FILE = os.environ.get("WARM_SPOTS_FILE")
+
+# File locked by the process running the warmer, so only one process of a server warms graphs
+WARMER_LOCK_FILE = os.environ.get("WARMER_LOCK_FILE", os.path.join("cache", "warmer.lock"))
+
+# Prepares the graphs, landmark indexes and weights of popular and configured start points in background threads,
+# so requests near them find a prepared graph
+class CacheWarmer:
+    def __init__(self, workers=None, interval=None):
+        self.workers = workers or WARMER_WORKERS
+        self.interval = interval or WARMER_INTERVAL
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cache-warmer")
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock_file = None
+        self.prepared = 0
+        self.failed = 0
+        self.last_check = None
+
+    # Starts warming in this process, unless another process already runs a warmer. Returns whether this one runs
+    def start(self):
+        if self.thread is None and self.acquire_lock():
+            if WARM_SPOTS_FILE:
+                self.load_configured(WARM_SPOTS_FILE)
+            self.thread = threading.Thread(target=self.run, daemon=True, name="cache-warmer")
+            self.thread.start()
+        return self.thread is not None
+
+    # Takes the warmer lock file, which is held until the process exits
+    def acquire_lock(self):
+        if self.lock_file is None:
+            directory = os.path.dirname(WARMER_LOCK_FILE)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            lock_file = open(WARMER_LOCK_FILE, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self.lock_file = lock_file
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+            self.stopped.wait(self.interval)
+
+    # Adds the spots of a configured list. Their start points are snapped when they are warmed
+    def load_configured(self, path):
+        with open(path) as f:
+            for spot in json.load(f):
+                lat, long = spot["coords"]
+                profiles = spot.get("preferences") or [dict()]
+                for profile in profiles:
+                    pref = read_preferences(profile.get("elevation"), profile.get("surface"), profile.get("nature"), profile.get("lighting"), profile.get("poi"))
+                    hotspots.record(("configured", lat, long), lat, long, float(spot["distance"]), pref, configured=True)
+
+    # Returns whether a spot should be prepared now
+    def is_due(self, spot, now):
+        if spot["key"] in self.in_flight:
+            return False
+        if not spot["configured"] and spot["requests"] < WARMER_MIN_REQUESTS:
+            return False
+        if spot["status"] == "failed":
+            return now - spot["failedAt"] > WARMER_RETRY_DELAY
+        if spot["preparedAt"] is None:
+            return True
+        return now - spot["preparedAt"] > WARMER_REFRESH_AGE or spot["preparedDistance"] < spot["distance"]
+
+    # Submits the due spots, most requested first, without running more than the number of workers at a time
+    def check(self):
+        if not packed_graph.PACKED_GRAPH_DIR:
+            return
+        now = time.time()
+        self.last_check = now
+        spots = [spot for spot in hotspots.snapshot() if self.is_due(spot, now)]
+        for spot in sorted(spots, key=lambda spot: (not spot["configured"], -spot["requests"])):
+            with self.lock:
+                if len(self.in_flight) >= self.workers:
+                    return
+                self.in_flight.add(spot["key"])
+            self.executor.submit(self.warm, spot)
+
+    def warm(self, spot):
+        key = spot["key"]
+        try:
+            lat, long = spot["coords"]
+            start_vertex = spot["center"]
+            if start_vertex is None:
+                start_vertex = snap_point(lat, long) if isinstance(key, tuple) else key
+
+            # Spots covered by the warm graph of another spot need no graph of their own
+            if spot["preparedAt"] is None and find_warm_graph(start_vertex, lat, long, spot["distance"]) is not None:
+                hotspots.update(key, status="covered")
+                return
+
+            hotspots.update(key, status="warming")
+            distance = spot["distance"] + 2 * WARM_SPOT_RADIUS
+            with metrics.timer("warm_graph"):
+                # The graph gets the layers of the preference profiles seen, later requests add the ones they miss
+                packed = get_prepared_graph(start_vertex, lat, long, distance, lambda stage: None, layers_for(spot["preferences"]),
+                                            refresh=spot["preparedAt"] is not None)
+                # The landmark index of each preference profile is stored with the graph
+                for pref in spot["preferences"]:
+                    get_landmark_index(get_routing_graph(packed.with_preferences(pref)), "weight_heuristic", background=False)
+
+            hotspots.update(key, status="warm", center=start_vertex, packedKey=packed_graph_key(start_vertex, distance),
+                            preparedDistance=distance, preparedAt=time.time(), error=None)
+            metrics.count("warmer_prepared")
+            self.prepared += 1
+        except Exception as e:
+            traceback.print_exc()
+            hotspots.update(key, status="failed", failedAt=time.time(), error=getattr(e, "message", str(e)))
+            metrics.count("warmer_failures")
+            self.failed += 1
+        finally:
+            with self.lock:
+                self.in_flight.discard(key)
+
+    # Returns the state of the warmer and of every spot. Coverage is the share of the tracked requests whose start
+    # vertex has a warm graph
+    def status(self):
+        spots = hotspots.snapshot()
+        requests = sum(spot["requests"] for spot in spots)
+        warm_requests = sum(spot["requests"] for spot in spots if spot["status"] in ("warm", "covered"))
+        return {"enabled": WARMER_ENABLED and bool(packed_graph.PACKED_GRAPH_DIR),
+                "running": self.thread is not None and self.thread.is_alive(),
+                "lastCheck": self.last_check,
+                "inFlight": len(self.in_flight),
+                "prepared": self.prepared,
+                "failed": self.failed,
+                "spots": len(spots),
+                "warmSpots": sum(spot["status"] == "warm" for spot in spots),
+                "coverage": warm_requests / requests if requests else None,
+                "hotspots": [{"coords": spot["coords"], "distance": spot["distance"], "requests": spot["requests"],
+                              "configured": spot["configured"], "status": spot["status"], "preparedAt": spot["preparedAt"],
+                              "error": spot["error"]}
+                             for spot in sorted(spots, key=lambda spot: -spot["requests"])]}